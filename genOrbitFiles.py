@@ -10,7 +10,7 @@ import os, argparse
 #runNames = ['ops2_1094', 'enigma_1257',
 #            'enigma_1258','enigma_1259','enigma_1189']
 
-def runThem(runName,useCamera=True):
+def runThem(runName,useCamera=True, nProcs=1):
 
 
     orbitfile = 'pha20141031.des'
@@ -26,16 +26,19 @@ def runThem(runName,useCamera=True):
     outfilename = runName+extraS+'_out.txt'
     runMoObs(orbitfile, outfilename,
              '/Users/yoachim/Scratch/Opsim_sqlites/'+runName+'_sqlite.db',
-             dbcols=dbcols, useCamera=useCamera)
+             dbcols=dbcols, useCamera=useCamera, nProcs=nProcs)
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('runName', type=str, default=None)
     parser.add_argument('--camera', dest="camera", action='store_true', default=False)
+    parser.add_argument('--nProcs', dest="nProcs", type=int, default=1)
     args, extras = parser.parse_known_args()
 
-    runThem(args.runName, useCamera=args.camera)
+    runThem(args.runName, useCamera=args.camera, nProcs=args.nProcs)
 
 
-    # To run in parallel:
+    # To run in parallel (one process per opsim run):
     # cat runList.txt | xargs -P 3 -I CMD bash -c './genOrbitFiles.py CMD --camera'
+    # Or to use several processes for a single opsim run:
+    # ./genOrbitFiles.py enigma_1189 --camera --nProcs 8
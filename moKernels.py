@@ -0,0 +1,187 @@
+"""
+Kernels for the moving object metrics, which evaluate a whole batch of objects at once.
+
+The observations of a batch of objects are held in 'CSR' layout: each observation column is a single
+(concatenated) array over all of the objects, and 'offsets' (of length nObj+1) gives the start of the
+observations of each object (so the observations of object i are [offsets[i]:offsets[i+1]]).
+The visibility 'vis' is a boolean (nObs, nH) matrix, one column per H value.
+
+If numba is available, the kernels are compiled loops; otherwise equivalent numpy code is used.
+"""
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+__all__ = ['HAS_NUMBA', 'useNumba', 'objIndex', 'segmentCount', 'countOccupiedBins', 'discoveryChances']
+
+# Set to False to use the numpy versions of the kernels even when numba is available.
+useNumba = HAS_NUMBA
+
+
+def objIndex(offsets):
+    """
+    Return the index of the object of each observation.
+    """
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def segmentCount(vis, offsets):
+    """
+    Count the number of True values in each column of vis, for each object. Returns an (nObj, nH) array.
+    """
+    counts = np.zeros((vis.shape[0] + 1, vis.shape[1]), int)
+    np.cumsum(vis, axis=0, out=counts[1:])
+    return counts[offsets[1:]] - counts[offsets[:-1]]
+
+
+def _binIndex(values, bins):
+    """
+    Return the index of the (np.histogram style) bin of each value, or -1 if outside the bins.
+    """
+    values = np.asarray(values)
+    binIdx = np.searchsorted(bins, values, side='right') - 1
+    binIdx = np.where(values == bins[-1], len(bins) - 2, binIdx)
+    return np.where((binIdx >= 0) & (binIdx < len(bins) - 1), binIdx, -1)
+
+
+def _countOccupiedBinsLoop(binIdx, offsets, vis, nBins, counts):
+    occupied = np.zeros(nBins, np.bool_)
+    for o in range(len(offsets) - 1):
+        for j in range(vis.shape[1]):
+            occupied[:] = False
+            n = 0
+            for k in range(offsets[o], offsets[o+1]):
+                b = binIdx[k]
+                if b >= 0 and vis[k, j] and not occupied[b]:
+                    occupied[b] = True
+                    n += 1
+            counts[o, j] = n
+
+
+def _countOccupiedBinsNumpy(binIdx, offsets, vis, nBins):
+    nObj = len(offsets) - 1
+    inBins = binIdx >= 0
+    key = (objIndex(offsets) * nBins + binIdx)[inBins]
+    occupied = np.zeros((nObj * nBins, vis.shape[1]), bool)
+    np.logical_or.at(occupied, key, vis[inBins])
+    return occupied.reshape(nObj, nBins, vis.shape[1]).sum(axis=1)
+
+
+def countOccupiedBins(values, offsets, bins, vis):
+    """
+    Count the number of (histogram) bins containing at least one visible value, for each object and
+    each column of vis. Bins follow np.histogram (the last bin includes its right edge).
+    Returns an (nObj, nH) array.
+    """
+    binIdx = _binIndex(values, bins)
+    nBins = len(bins) - 1
+    if useNumba:
+        counts = np.zeros((len(offsets) - 1, vis.shape[1]), int)
+        _countOccupiedBinsLoop(binIdx, np.asarray(offsets, np.int64), np.ascontiguousarray(vis), nBins, counts)
+        return counts
+    return _countOccupiedBinsNumpy(binIdx, offsets, vis, nBins)
+
+
+def _discoveryChancesLoop(nights, times, offsets, vis, nObsPerNight, tNight, nNightsPerWindow, tWindow,
+                          timeBins, counts):
+    visIdx = np.zeros(len(nights), np.int64)
+    trackNights = np.zeros(len(nights), np.float64)
+    for o in range(len(offsets) - 1):
+        for j in range(vis.shape[1]):
+            # The visible observations of this object, at this H.
+            nVis = 0
+            for k in range(offsets[o], offsets[o+1]):
+                if vis[k, j]:
+                    visIdx[nVis] = k
+                    nVis += 1
+            # The nights with tracklets.
+            nTrack = 0
+            for q in range(nVis - nObsPerNight + 1):
+                a = visIdx[q]
+                b = visIdx[q + nObsPerNight - 1]
+                if nights[a] == nights[b] and times[b] - times[a] <= tNight:
+                    if nTrack == 0 or trackNights[nTrack - 1] != nights[a]:
+                        trackNights[nTrack] = nights[a]
+                        nTrack += 1
+            # The sets of tracklet nights within tWindow, counted in each time bin after their last night.
+            for q in range(nTrack - nNightsPerWindow + 1):
+                lastNight = trackNights[q + nNightsPerWindow - 1]
+                if lastNight - trackNights[q] <= tWindow:
+                    for t in range(len(timeBins)):
+                        if lastNight < timeBins[t]:
+                            counts[o, j, t] += 1
+
+
+def _discoveryChancesNumpy(nights, times, offsets, vis, nObsPerNight, tNight, nNightsPerWindow, tWindow, timeBins):
+    nObj = len(offsets) - 1
+    nH = vis.shape[1]
+    obsObj = objIndex(offsets)
+    # List the visible observations of each (column, object) together; within each, they are in time order.
+    visCol, visObs = np.nonzero(vis.T)
+    visKey = visCol * nObj + obsObj[visObs]
+    # Find the visible observations which start a tracklet.
+    end = np.arange(nObsPerNight - 1, len(visKey) + nObsPerNight - 1)
+    valid = end < len(visKey)
+    end = np.where(valid, end, 0)
+    tracklet = (valid & (visKey[end] == visKey) & (nights[visObs[end]] == nights[visObs]) &
+                (times[visObs[end]] - times[visObs] <= tNight))
+    # Reduce to the unique (column, object, night) with tracklets.
+    trackKey = visKey[tracklet]
+    trackNight = nights[visObs[tracklet]]
+    first = np.ones(len(trackKey), bool)
+    first[1:] = (trackKey[1:] != trackKey[:-1]) | (trackNight[1:] != trackNight[:-1])
+    trackKey = trackKey[first]
+    trackNight = trackNight[first]
+    # Find the tracklet nights which start a track.
+    end = np.arange(nNightsPerWindow - 1, len(trackKey) + nNightsPerWindow - 1)
+    valid = end < len(trackKey)
+    end = np.where(valid, end, 0)
+    track = valid & (trackKey[end] == trackKey) & (trackNight[end] - trackNight <= tWindow)
+    # Each track counts in the time bins after its last night.
+    nT = len(timeBins)
+    firstBin = np.searchsorted(timeBins, trackNight[end][track], side='right')
+    counts = np.bincount(trackKey[track] * (nT + 1) + firstBin, minlength=nH * nObj * (nT + 1))
+    counts = counts.reshape(nH, nObj, nT + 1).cumsum(axis=2)[:, :, :nT]
+    return counts.transpose(1, 0, 2)
+
+
+def discoveryChances(nights, times, offsets, vis, nObsPerNight, tNight, nNightsPerWindow, tWindow, timeBins=None):
+    """
+    Count the discovery chances for each object and each column of vis.
+    A night has a tracklet if it has (at least) nObsPerNight visible observations within tNight (days),
+    and each set of nNightsPerWindow nights with tracklets within tWindow (days) is a discovery chance.
+    Returns an (nObj, nH) array.
+    @ timeBins : if not None, an (increasing) array of nights - count the discovery chances completed before each
+      of these nights instead (i.e. using only the observations with night < timeBins[t]),
+      returning an (nObj, nH, len(timeBins)) array.
+    """
+    nights = np.asarray(nights, float)
+    times = np.asarray(times, float)
+    if timeBins is None:
+        cutoffs = np.array([np.inf])
+    else:
+        cutoffs = np.asarray(timeBins, float)
+    # Put the observations of each object in time order.
+    order = np.lexsort((times, nights, objIndex(offsets)))
+    nights = nights[order]
+    times = times[order]
+    vis = vis[order]
+    if useNumba:
+        counts = np.zeros((len(offsets) - 1, vis.shape[1], len(cutoffs)), int)
+        _discoveryChancesLoop(nights, times, np.asarray(offsets, np.int64), vis, nObsPerNight, tNight,
+                              nNightsPerWindow, tWindow, cutoffs, counts)
+    else:
+        counts = _discoveryChancesNumpy(nights, times, offsets, vis, nObsPerNight, tNight,
+                                        nNightsPerWindow, tWindow, cutoffs)
+    if timeBins is None:
+        return counts[:, :, 0]
+    return counts
+
+
+if HAS_NUMBA:
+    _countOccupiedBinsLoop = numba.njit(cache=True)(_countOccupiedBinsLoop)
+    _discoveryChancesLoop = numba.njit(cache=True)(_discoveryChancesLoop)
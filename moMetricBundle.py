@@ -1,11 +1,15 @@
 import os
-from copy import deepcopy
+import ctypes
+from copy import copy
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 import numpy.ma as ma
 import matplotlib.pyplot as plt
 
-from moSlicer import MoSlicer
 from moMetrics import BaseMoMetric
+from moStackers import MoVisibilityStacker
+from moMetricValues import MoMetricValues
 import moPlots as moPlots
 import lsst.sims.maf.utils as utils
 from lsst.sims.maf.plots import PlotHandler, BasePlotter
@@ -20,6 +24,8 @@ class MoMetricBundle(object):
         """
         Instantiate moving object metric bundle, save metric/slicer/constraint, etc.
         """
+        # A pending (lazy) reduction of another bundle, which calculates the metric values (see reduceMetric).
+        self._pendingReduce = None
         self.metric = metric
         self.slicer = slicer
         if constraint == '':
@@ -41,6 +47,49 @@ class MoMetricBundle(object):
         self.metricValues = None
         self.summaryValues = None
 
+    @property
+    def metricValues(self):
+        self._applyReduce()
+        return self._metricValues
+
+    @metricValues.setter
+    def metricValues(self, metricValues):
+        self._pendingReduce = None
+        self._metricValues = metricValues
+
+    @property
+    def slicer(self):
+        self._applyReduce()
+        return self._slicer
+
+    @slicer.setter
+    def slicer(self, slicer):
+        self._slicer = slicer
+
+    def _applyReduce(self):
+        """
+        Calculate the metric values (and slicer) of a bundle made by reduceMetric, if not yet done.
+        """
+        if self._pendingReduce is None:
+            return
+        parent, reduceFunc = self._pendingReduce
+        metricValues, Hvals = reduceFunc(parent.metricValues, parent.slicer.slicePoints['H'])
+        if isinstance(parent.metricValues, MoMetricValues):
+            metricValues = MoMetricValues(metricValues)
+        slicer = parent.slicer
+        if metricValues.shape[1] != parent.slicer.slicerShape[1]:
+            # Then something happened with reduceFunction --
+            #  .. usually, this would be with 'completeness'. It can reshape the metric values so that
+            #  (a) if we cloned H, we now go from multiple metricvalues per H value to a single value per H [(nSso, nHrange) -> (1, nHrange)]
+            #  (b) if we did not clone H, we now have a binned metricvalues - one per H bin, instead of one per nsso [(nSso, 1) -> (nHrange, nHrange)]
+            # and we don't really care (in general) because we won't be re-slicing the observations. But we do need to update the slicePoints['H'],
+            #  so use a copy of the slicer (sharing its orbits) with the new H values.
+            slicer = parent.slicer.withHrange(Hvals)
+        # Only drop the pending reduction once the values are set (so a failed reduction can be retried).
+        self._metricValues = metricValues
+        self._slicer = slicer
+        self._pendingReduce = None
+
     def _buildFileRoot(self, fileRoot=None):
         """
         Build an auto-generated output filename root (i.e. minus the plot type or .npz ending).
@@ -69,13 +118,19 @@ class MoMetricBundle(object):
     def _setupMetricValues(self):
         """
         Set up the numpy masked array to store the metric value data.
+        Note that runAll sets up (and fills) these dense arrays for the bundles of every constraint at once,
+        so the peak memory use is that of all of the bundles at full size, even when using compact storage
+        (MoMetricBundleGroup(compact=True) only shrinks the metric values once they are all calculated).
+        Run fewer constraints at a time (runCurrent) to reduce the peak memory use.
         """
         dtype = self.metric.metricDtype
         # Can't store some mask values in an int array.
         if dtype == 'int':
             dtype = 'float'
-        self.metricValues = ma.MaskedArray(data = np.empty(self.slicer.slicerShape, dtype),
-                                            mask = np.zeros(self.slicer.slicerShape, 'bool'),
+        # One value per slicePoint per H (and per time bin, for time-resolved metrics).
+        shape = (self.slicer.slicerShape[0],) + self.metric.valueShape(self.slicer.slicerShape[1])
+        self.metricValues = ma.MaskedArray(data = np.empty(shape, dtype),
+                                            mask = np.zeros(shape, 'bool'),
                                             fill_value= self.slicer.badval)
 
     def setSummaryMetrics(self, summaryMetrics):
@@ -123,13 +178,23 @@ class MoMetricBundle(object):
     def reduceMetric(self, reduceFunc, reducePlotDict=None, reduceDisplayDict=None):
         """
         Run reduce methods on the metric bundle, such as completeness or integrate over H distribution.
-        These return a new metric bundle.
+        These return a new metric bundle. The new metric values are only calculated (from the metric values of this
+        bundle, at that time) when they are first used, e.g. when plotted or summarized - so reductions can be chained
+        without calculating the intermediate values until needed.
         """
         rName = reduceFunc.__name__.replace('reduce', '')
         reduceName = self.metric.name + '_' + rName
-        newmetric = deepcopy(self.metric)
+        newmetric = copy(self.metric)
         newmetric.name = reduceName
-        newBundle = MoMetricBundle(metric=newmetric, slicer=self.slicer,
+        # Don't share the (mutable) attributes of the metric of this bundle.
+        newmetric.colsReq = list(self.metric.colsReq)
+        newmetric.reduceOrder = dict(self.metric.reduceOrder)
+        newmetric.reduceUnits = dict(self.metric.reduceUnits)
+        if self.metric.timeBins is not None:
+            newmetric.timeBins = np.array(self.metric.timeBins)
+        # Use the reduce functions of the new metric (so they can update its attributes, such as units).
+        newmetric.reduceFuncs = dict([(k, getattr(newmetric, f.__name__)) for k, f in self.metric.reduceFuncs.iteritems()])
+        newBundle = MoMetricBundle(metric=newmetric, slicer=self._slicer,
                                    constraint=self.constraint,
                                    runName=self.runName, metadata=self.metadata,
                                    plotDict=self.plotDict, plotFuncs=self.plotFuncs,
@@ -144,17 +209,11 @@ class MoMetricBundle(object):
             if 'ylabel' in newBundle.plotDict:
                 newBundle.plotDict['ylabel'] = newBundle.plotDict['ylabel'].replace('@H', '<=H')
         newBundle._buildFileRoot()
-        # Calculate new metric values.
-        newBundle.metricValues, Hvals = reduceFunc(self.metricValues, self.slicer.slicePoints['H'])
-        if newBundle.metricValues.shape[1] != self.slicer.slicerShape[1]:
-            # Then something happened with reduceFunction --
-            #  .. usually, this would be with 'completeness'. It can reshape the metric values so that
-            #  (a) if we cloned H, we now go from multiple metricvalues per H value to a single value per H [(nSso, nHrange) -> (1, nHrange)]
-            #  (b) if we did not clone H, we now have a binned metricvalues - one per H bin, instead of one per nsso [(nSso, 1) -> (nHrange, nHrange)]
-            # and we don't really care (in general) because we won't be re-slicing the observations. But we do need to update the slicePoints['H'],
-            #  and for that we need a new slicer. Rereading the orbit file is a bit of a pain, but not too bad.
-            newslicer = MoSlicer(orbitfile=self.slicer.orbitfile, Hrange=Hvals)
-            newBundle.slicer = newslicer
+        # Reduce with the method of the new metric, if reduceFunc is a method of the metric of this bundle.
+        if getattr(reduceFunc, '__self__', None) is self.metric:
+            reduceFunc = getattr(newmetric, reduceFunc.__name__)
+        # The new metric values are calculated when first needed.
+        newBundle._pendingReduce = (self, reduceFunc)
         return newBundle
 
     def computeSummaryStats(self, resultsDb=None):
@@ -222,9 +281,20 @@ class MoMetricBundle(object):
 ####
 
 class MoMetricBundleGroup(object):
-    def __init__(self, bundleDict, outDir='.', resultsDb=None, verbose=True):
+    def __init__(self, bundleDict, outDir='.', resultsDb=None, verbose=True, resultStore=None, compact=False):
+        """
+        @ resultStore : an optional MoResultStore. If set, metric values are only calculated at slicePoints
+          where the observations (or metric configuration) have changed since the values were saved in the store,
+          and the store is saved after runAll. The store is only used when running with a seed, as the metric values
+          calculated without a seed are just one draw of the random visibility calculation.
+        @ compact : if True, the metric values of each bundle are converted to a (float32, sparse) MoMetricValues
+          container once they are calculated, to save memory when holding many bundles. This does not reduce
+          the peak memory use while calculating the metric values (see MoMetricBundle._setupMetricValues).
+        """
         # Not really handling resultsDb yet.
         self.verbose = verbose
+        self.resultStore = resultStore
+        self.compact = compact
         self.bundleDict = bundleDict
         self.outDir = outDir
         if not os.path.isdir(self.outDir):
@@ -246,29 +316,197 @@ class MoMetricBundleGroup(object):
             if b.constraint == constraint:
                 self.currentBundleDict[k] = b
 
-    def runCurrent(self, constraint):
+    def _constrainSlicePoint(self, slicePoint, constraint):
         """
-        Calculate the metric values for set of bundles using the same constraint and slicer.
+        Return the slicePoint with only the observations matching constraint
+        (using the constraint masks calculated by the slicer).
         """
-        self.slicer.subsetObs(constraint)
-        for b in self.currentBundleDict.itervalues():
-            b._setupMetricValues()
-        for i, slicePoint in enumerate(self.slicer):
-            ssoObs = slicePoint['obs']
-            for j, Hval in enumerate(slicePoint['Hvals']):
-                for b in self.currentBundleDict.itervalues():
-                    if len(ssoObs) == 0:
-                        b.metricValues.mask[i][j] = True
-                    else:
-                        b.metricValues.data[i][j] = b.metric.run(ssoObs, slicePoint['orbit'], Hval)
-
-    def runAll(self):
+        if constraint is None:
+            return slicePoint
+        return {'obs': slicePoint['obs'][slicePoint['constraintMasks'][constraint]],
+                'orbit': slicePoint['orbit'],
+                'Hvals': slicePoint['Hvals']}
+
+    def _calcSlicePoints(self, slicePoints, stacker, data, mask, seed=None, batchSize=None):
+        """
+        Calculate the metric values of the bundles being run (self.runBundles, a dictionary of the bundles for
+        each constraint) at each (index, slicePoint) in slicePoints, storing them in the data/mask arrays
+        (dictionaries keyed as bundleDict). Each slicePoint is sliced once, and the observations for each constraint
+        are then selected with the constraint masks.
+        If there is a resultStore (and a seed), saved metric values are used where available, and the newly calculated
+        metric values are returned as a list of (metricKey, slicePointKey, metricValues) - together with the keys of
+        the saved metric values which were used, with metricValues None.
+        If batchSize is not None, slicePoints are calculated in batches of batchSize (with runBatch).
+        """
+        metricKeys = None
+        useStore = self.resultStore is not None and seed is not None
+        if useStore:
+            metricKeys = {}
+            for bundles in self.runBundles.itervalues():
+                for k, b in bundles.iteritems():
+                    metricKeys[k] = self.resultStore.metricKey(b.metric)
+        newResults = []
+        pending = dict([(constraint, []) for constraint in self.runBundles])
+        for i, fullSlicePoint in slicePoints:
+            for constraint, bundles in self.runBundles.iteritems():
+                slicePoint = self._constrainSlicePoint(fullSlicePoint, constraint)
+                ssoObs = slicePoint['obs']
+                if len(ssoObs) == 0:
+                    for k in bundles:
+                        mask[k][i] = True
+                    continue
+                # Find which bundles need to be calculated at this slicePoint.
+                todo = bundles.keys()
+                slicePointKey = None
+                if useStore:
+                    slicePointKey = self.resultStore.slicePointKey(slicePoint, seed)
+                    todo = []
+                    for k in bundles:
+                        metricValues = self.resultStore.get(metricKeys[k], slicePointKey)
+                        if metricValues is None:
+                            todo.append(k)
+                        else:
+                            data[k][i] = metricValues
+                            newResults.append((metricKeys[k], slicePointKey, None))
+                if len(todo) == 0:
+                    continue
+                if batchSize is not None:
+                    pending[constraint].append((i, slicePoint, slicePointKey, todo))
+                    if len(pending[constraint]) == batchSize:
+                        newResults += self._calcBatch(pending[constraint], bundles, stacker, data, metricKeys)
+                        pending[constraint] = []
+                    continue
+                stacker.reset(ssoObs, slicePoint['orbit'], slicePoint['Hvals'])
+                for k in todo:
+                    # Calculate the metric for all Hvals at once.
+                    data[k][i] = bundles[k].metric.runH(ssoObs, slicePoint['orbit'], slicePoint['Hvals'],
+                                                        stacker=stacker)
+                    if metricKeys is not None:
+                        newResults.append((metricKeys[k], slicePointKey, data[k][i].copy()))
+        for constraint, bundles in self.runBundles.iteritems():
+            if len(pending[constraint]) > 0:
+                newResults += self._calcBatch(pending[constraint], bundles, stacker, data, metricKeys)
+        return newResults
+
+    def _calcBatch(self, pending, bundles, stacker, data, metricKeys=None):
+        """
+        Calculate the metric values of bundles for a batch of (index, slicePoint, slicePointKey, bundle keys to
+        calculate), storing them in the data arrays. Returns the list of new results for the resultStore (if metricKeys).
+        """
+        batch = self.slicer.makeBatch([slicePoint for i, slicePoint, slicePointKey, todo in pending])
+        stacker.resetBatch(batch)
+        newResults = []
+        for k, b in bundles.iteritems():
+            rows = [j for j, p in enumerate(pending) if k in p[3]]
+            if len(rows) == 0:
+                continue
+            metricValues = b.metric.runBatch(batch, stacker=stacker)
+            for j in rows:
+                i, slicePoint, slicePointKey, todo = pending[j]
+                data[k][i] = metricValues[j]
+                if metricKeys is not None:
+                    newResults.append((metricKeys[k], slicePointKey, metricValues[j].copy()))
+        return newResults
+
+    def _storeResults(self, newResults):
         """
-        Run all constraints and metrics for these moMetricBundles.
+        Add newly calculated metric values to the resultStore (and record which saved metric values were used).
         """
-        for constraint in self.constraints:
-            self._setCurrent(constraint)
-            self.runCurrent(constraint)
+        if self.resultStore is None:
+            return
+        for metricKey, slicePointKey, metricValues in newResults:
+            if metricValues is None:
+                self.resultStore.markUsed(metricKey, slicePointKey)
+            else:
+                self.resultStore.put(metricKey, slicePointKey, metricValues)
+
+    def _runConstraints(self, constraints, nProcs=1, seed=None, batchSize=None):
+        """
+        Calculate the metric values for all the bundles with any of constraints, in a single pass through the
+        slicer: the observations of each slicePoint are sliced once, and each constraint is applied as a boolean mask.
+        """
+        self.runBundles = {}
+        for constraint in constraints:
+            self.runBundles[constraint] = {}
+            for k, b in self.bundleDict.iteritems():
+                if b.constraint == constraint:
+                    self.runBundles[constraint][k] = b
+                    b._setupMetricValues()
+        runBundleDict = {}
+        for bundles in self.runBundles.itervalues():
+            runBundleDict.update(bundles)
+        self.slicer.subsetObs()
+        self.slicer.setConstraints(constraints)
+        nSlicePoints = self.slicer.slicerShape[0]
+        if nProcs <= 1 or nSlicePoints < 2:
+            data = dict([(k, b.metricValues.data) for k, b in runBundleDict.iteritems()])
+            mask = dict([(k, b.metricValues.mask) for k, b in runBundleDict.iteritems()])
+            # The visibility calculations are shared between the metrics at each slicepoint.
+            stacker = MoVisibilityStacker(seed=seed)
+            newResults = self._calcSlicePoints(enumerate(self.slicer), stacker, data, mask, seed, batchSize)
+            self._storeResults(newResults)
+            self._compactBundles(runBundleDict)
+            return
+        if self.slicer.chunkSize is not None:
+            raise ValueError('Cannot run metrics in parallel when streaming the observations (chunkSize set).')
+        # Set up shared memory for the metric values, which the worker processes fill in.
+        data = {}
+        mask = {}
+        for k, b in runBundleDict.iteritems():
+            data[k] = _sharedArray(b.metricValues.data)
+            mask[k] = _sharedArray(b.metricValues.mask)
+        # Split the slicePoints into more shards than processes, to keep all workers busy.
+        nShards = min(nSlicePoints, nProcs * 4)
+        bounds = np.linspace(0, nSlicePoints, nShards + 1).astype(int)
+        shards = [(bounds[i], bounds[i+1]) for i in range(nShards)]
+        pool = Pool(nProcs, initializer=_initMoMetricWorker, initargs=(self, data, mask, seed, batchSize))
+        try:
+            shardResults = pool.map(_runMoMetricShard, shards)
+        finally:
+            pool.close()
+            pool.join()
+        for newResults in shardResults:
+            self._storeResults(newResults)
+        for k, b in runBundleDict.iteritems():
+            b.metricValues = ma.MaskedArray(data = data[k].copy(), mask = mask[k].copy(),
+                                            fill_value = self.slicer.badval)
+        self._compactBundles(runBundleDict)
+
+    def _compactBundles(self, bundleDict):
+        """
+        Convert the metric values of the bundles in bundleDict to MoMetricValues, if using compact storage.
+        """
+        if not self.compact:
+            return
+        for b in bundleDict.itervalues():
+            b.metricValues = MoMetricValues(b.metricValues)
+
+    def runCurrent(self, constraint, nProcs=1, seed=None, batchSize=None):
+        """
+        Calculate the metric values for set of bundles using the same constraint and slicer.
+        @ nProcs : the number of processes to use. If more than one, the slicePoints are split into shards
+           which are evaluated in a pool of (forked) worker processes, writing into shared memory.
+        @ seed : if not None, the random visibility calculation at each slicePoint uses random numbers derived from
+           (seed, objId, H index, visibility requirements), so that results are identical whether run serially or in
+           parallel (see MoVisibilityStacker).
+        @ batchSize : if not None, evaluate the metrics for batches of batchSize slicePoints at once (with runBatch),
+           rather than one slicePoint at a time.
+        """
+        self._runConstraints([constraint], nProcs=nProcs, seed=seed, batchSize=batchSize)
+        if self.resultStore is not None:
+            self.resultStore.save()
+
+    def runAll(self, nProcs=1, seed=None, batchSize=None):
+        """
+        Run all constraints and metrics for these moMetricBundles.
+        All of the constraints are calculated together, in a single pass through the slicer.
+        @ nProcs : the number of processes to use to calculate the metric values.
+        @ seed : if not None, seed the random visibility calculation for each slicePoint (see runCurrent).
+        @ batchSize : if not None, the number of slicePoints to evaluate at once (see runCurrent).
+        """
+        self._runConstraints(self.constraints, nProcs=nProcs, seed=seed, batchSize=batchSize)
+        if self.resultStore is not None:
+            self.resultStore.save()
         if self.verbose:
             print 'Calculated all metrics.'
 
@@ -284,14 +522,41 @@ class MoMetricBundleGroup(object):
             print 'Plotting complete.'
 
     def plotAll(self, savefig=True, outfileSuffix=None, figformat='pdf', dpi=600, thumbnail=True,
-                closefigs=True):
+                closefigs=True, nProcs=1):
         """
         Make a few generically desired plots. This needs more flexibility in the future.
-        """
-        for constraint in self.constraints:
-            self._setCurrent(constraint)
-            self.plotCurrent(savefig=savefig, outfileSuffix=outfileSuffix, figformat=figformat, dpi=dpi,
-                             thumbnail=thumbnail, closefigs=closefigs)
+        @ nProcs : the number of processes to use. If more than one, the plots of each bundle are drawn and saved
+          by a pool of worker processes (with the non-interactive Agg backend), after the slicePoints are binned
+          once in this process. The resultsDb entries of each plot are made here, in the same order as when plotting
+          serially. The figures are always closed after saving.
+        """
+        if nProcs <= 1:
+            for constraint in self.constraints:
+                self._setCurrent(constraint)
+                self.plotCurrent(savefig=savefig, outfileSuffix=outfileSuffix, figformat=figformat, dpi=dpi,
+                                 thumbnail=thumbnail, closefigs=closefigs)
+        else:
+            keys = []
+            for constraint in self.constraints:
+                self._setCurrent(constraint)
+                keys += self.currentBundleDict.keys()
+            # Bin the slicePoints (cached on the slicers) before forking, so the workers share the bin indexes.
+            for k in keys:
+                b = self.bundleDict[k]
+                for plotFunc in b.plotFuncs:
+                    if hasattr(plotFunc, 'binSlicePoints'):
+                        plotFunc.binSlicePoints(b.slicer, b.plotDict)
+            plotKwargs = {'savefig':savefig, 'outfileSuffix':outfileSuffix, 'figformat':figformat,
+                          'dpi':dpi, 'thumbnail':thumbnail, 'recordResults':self.resultsDb is not None}
+            pool = Pool(nProcs, initializer=_initMoPlotWorker, initargs=(self, plotKwargs))
+            try:
+                recordedCalls = pool.map(_plotMoMetricBundle, keys)
+            finally:
+                pool.close()
+                pool.join()
+            if self.resultsDb is not None:
+                for calls in recordedCalls:
+                    _ResultsDbRecorder.replay(calls, self.resultsDb)
         if self.verbose:
             print 'Plotted all metrics.'
 
@@ -344,3 +609,109 @@ class MoMetricBundleGroup(object):
         for constraint in self.constraints:
             self._setCurrent(constraint)
             self.summaryCurrent()
+
+
+def _sharedArray(array):
+    """
+    Return a copy of the numpy array, in (process) shared memory.
+    """
+    raw = RawArray(ctypes.c_byte, array.nbytes)
+    shared = np.frombuffer(raw, dtype=array.dtype).reshape(array.shape)
+    shared[:] = array
+    return shared
+
+_workerGroup = None
+_workerData = None
+_workerMask = None
+_workerSeed = None
+_workerBatchSize = None
+
+def _initMoMetricWorker(bundleGroup, data, mask, seed, batchSize):
+    """
+    Set up a worker process (forked, so the bundle group, slicer and shared arrays are inherited).
+    """
+    global _workerGroup, _workerData, _workerMask, _workerSeed, _workerBatchSize
+    _workerGroup = bundleGroup
+    _workerData = data
+    _workerMask = mask
+    _workerSeed = seed
+    _workerBatchSize = batchSize
+    if seed is None:
+        # Don't let all of the workers share the random number sequence inherited from the parent.
+        np.random.seed()
+
+def _runMoMetricShard(shard):
+    """
+    Calculate the metric values for one shard (a contiguous range of slicePoints) in a worker process.
+    Returns the newly calculated results, for the resultStore.
+    """
+    shardStart, shardEnd = shard
+    slicer = _workerGroup.slicer
+    stacker = MoVisibilityStacker(seed=_workerSeed)
+    slicePoints = ((i, slicer[i]) for i in range(shardStart, shardEnd))
+    return _workerGroup._calcSlicePoints(slicePoints, stacker, _workerData, _workerMask, _workerSeed,
+                                         _workerBatchSize)
+
+
+class _ResultsDbRecorder(object):
+    """
+    Stand in for the resultsDb in a plotting worker process: record the calls made to the resultsDb,
+    so they can be replayed (in order) on the real resultsDb in the main process.
+    Calls return a placeholder for their result (e.g. a metricId), which is replaced by the real result on replay.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return _RecordedResult(len(self.calls) - 1)
+        return record
+
+    @staticmethod
+    def replay(calls, resultsDb):
+        results = []
+        def real(value):
+            if isinstance(value, _RecordedResult):
+                return results[value.callIdx]
+            return value
+        for name, args, kwargs in calls:
+            args = [real(a) for a in args]
+            kwargs = dict([(k, real(v)) for k, v in kwargs.iteritems()])
+            results.append(getattr(resultsDb, name)(*args, **kwargs))
+
+
+class _RecordedResult(object):
+    def __init__(self, callIdx):
+        self.callIdx = callIdx
+
+_workerPlotGroup = None
+_workerPlotKwargs = None
+
+def _initMoPlotWorker(bundleGroup, plotKwargs):
+    """
+    Set up a plotting worker process.
+    """
+    global _workerPlotGroup, _workerPlotKwargs
+    _workerPlotGroup = bundleGroup
+    _workerPlotKwargs = plotKwargs
+    plt.switch_backend('Agg')
+
+def _plotMoMetricBundle(key):
+    """
+    Draw and save the plots of one bundle in a worker process, returning the recorded resultsDb calls.
+    """
+    b = _workerPlotGroup.bundleDict[key]
+    kw = _workerPlotKwargs
+    resultsDb = None
+    if kw['recordResults']:
+        resultsDb = _ResultsDbRecorder()
+    plotHandler = PlotHandler(outDir=_workerPlotGroup.outDir, resultsDb=resultsDb, savefig=kw['savefig'],
+                              figformat=kw['figformat'], dpi=kw['dpi'], thumbnail=kw['thumbnail'])
+    b.plot(plotHandler=plotHandler, outfileSuffix=kw['outfileSuffix'], savefig=kw['savefig'])
+    plt.close('all')
+    if resultsDb is None:
+        return []
+    return resultsDb.calls
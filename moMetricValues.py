@@ -0,0 +1,86 @@
+import numpy as np
+import numpy.ma as ma
+
+__all__ = ['MoMetricValues', 'asMaskedArray']
+
+
+class MoMetricValues(object):
+    """
+    A compact (read-only) container for the metric values of a moving object metric bundle
+    (nSso, nH[, nTimeBins]), to use instead of the full masked array once the metric values are calculated.
+
+    The values are stored as float32, and the mask as packed bits. Only the 'dense' rows (slicePoints)
+    are stored - rows where every value is masked or equal to emptyValue (e.g. objects which were never
+    observed) are recorded by the mask and the list of dense rows alone.
+    asMaskedArray() returns the equivalent masked array (with the original dtype); the masked array accessors
+    (indexing, data, mask, filled, compressed, reshape, swapaxes) are provided for existing callers, but each of
+    these expands the full masked array - use asMaskedArray() once where several are needed.
+    """
+    def __init__(self, metricValues, emptyValue=0):
+        """
+        @ metricValues : the masked array of metric values to store.
+        @ emptyValue : the value of the rows which don't need to be stored.
+        """
+        metricValues = ma.asarray(metricValues)
+        self.shape = metricValues.shape
+        self.dtype = metricValues.dtype
+        self.fill_value = metricValues.fill_value
+        self.emptyValue = emptyValue
+        mask = ma.getmaskarray(metricValues)
+        self.packedMask = np.packbits(mask.ravel())
+        nRows = self.shape[0]
+        empty = (mask | (metricValues.data == emptyValue)).reshape(nRows, -1).all(axis=1)
+        self.rows = np.where(~empty)[0].astype(np.int32)
+        self.rowData = np.asarray(metricValues.data[self.rows], np.float32)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.packedMask.nbytes + self.rows.nbytes + self.rowData.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def data(self):
+        return self.asMaskedArray().data
+
+    @property
+    def mask(self):
+        return self.asMaskedArray().mask
+
+    def __getitem__(self, idx):
+        return self.asMaskedArray()[idx]
+
+    def filled(self, fill_value=None):
+        return self.asMaskedArray().filled(fill_value)
+
+    def compressed(self):
+        return self.asMaskedArray().compressed()
+
+    def reshape(self, *shape):
+        return self.asMaskedArray().reshape(*shape)
+
+    def swapaxes(self, axis1, axis2):
+        return self.asMaskedArray().swapaxes(axis1, axis2)
+
+    def asMaskedArray(self):
+        """
+        Return the metric values as a (new) masked array.
+        """
+        mask = np.unpackbits(self.packedMask)[:int(np.prod(self.shape))].reshape(self.shape).astype(bool)
+        data = np.zeros(self.shape, self.dtype) + self.emptyValue
+        data[self.rows] = self.rowData
+        return ma.MaskedArray(data = data, mask = mask, fill_value = self.fill_value)
+
+
+def asMaskedArray(metricValues):
+    """
+    Return metricValues (a masked array, or MoMetricValues) as a masked array.
+    """
+    if isinstance(metricValues, MoMetricValues):
+        return metricValues.asMaskedArray()
+    return ma.asarray(metricValues)
@@ -2,6 +2,9 @@ import inspect
 import numpy as np
 import numpy.ma as ma
 from lsst.sims.maf.metrics import MetricRegistry
+from moStackers import MoVisibilityStacker
+import moKernels
+from moMetricValues import asMaskedArray
 
 __all__ = ['BaseMoMetric', 'NObsMetric', 'DiscoveryChancesMetric',
            'ActivityOverTimeMetric', 'ActivityOverPeriodMetric']
@@ -10,6 +13,10 @@ __all__ = ['BaseMoMetric', 'NObsMetric', 'DiscoveryChancesMetric',
 class BaseMoMetric(object):
     """Base class for the moving object metrics."""
     __metaclass__ = MetricRegistry
+    # Increase the metricVersion of a metric when a change outside of its class (e.g. in moKernels) changes its
+    # metric values, so that results saved in a MoResultStore are recalculated (changes to the class source are
+    # detected automatically).
+    metricVersion = 1
 
     def __init__(self, metricName=None, units='#', badval=0,
                  m5Col='fiveSigmaDepth', lossCol='dmagDetect',
@@ -30,6 +37,8 @@ class BaseMoMetric(object):
         self.nightCol = nightCol
         self.expMJDCol = expMJDCol
         self.snrLimit = None
+        # Metrics with a time-resolved mode set timeBins, and then have one value per time bin.
+        self.timeBins = None
         self.colsReq = [self.m5Col, self.lossCol, self.magFilterCol,
                         self.nightCol, self.expMJDCol]
         # Set parameters used for reduce methods.
@@ -110,9 +119,133 @@ class BaseMoMetric(object):
             vis = np.where(snr >= self.snrLimit)[0]
         return appMag, magLimit, vis, snr
 
+    def _calcVisH(self, appMag, magLimit, sigma=0.12, probability=None):
+        """
+        Calculate whether an object is visible (as in _calcVis), for a matrix of appMag (nObs, nH).
+        Returns a boolean matrix (nObs, nH).
+        @ probability : the (nObs, nH) matrix of random numbers to compare against the completeness.
+          If None, random numbers are drawn from the global numpy generator, in the same order as calling
+          _calcVis for each H value in turn.
+        """
+        completeness = 1.0 / (1 + np.exp((appMag - magLimit)/sigma))
+        if probability is None:
+            probability = np.random.random_sample(appMag.shape[::-1]).T
+        return probability <= completeness
+
+    def _calcAppMagH(self, ssoObs, orb, Hvals):
+        """
+        Calculate the apparent magnitudes (nObs, nH) of the object for each of the values in Hvals.
+        As in _prep, an Hval of None means the H value of the orbit.
+        """
+        Href = orb['H']
+        if Hvals is None:
+            Hvals = [Href]
+        Hvals = np.array([Href if Hval is None else Hval for Hval in Hvals], float)
+        return (ssoObs[self.magFilterCol][:, np.newaxis] + Hvals[np.newaxis, :]) - Href
+
+    def _calcVisibilityH(self, appMag, magLimit, probability=None):
+        """
+        Calculate the visibility (a boolean matrix, True where the object is visible) and the snr
+        (or None if not using snrLimit) for a matrix of appMag (nObs, nH).
+        @ probability : passed to _calcVisH if not using snrLimit.
+        """
+        if self.snrLimit is None:
+            snr = None
+            vis = self._calcVisH(appMag, magLimit, probability=probability)
+        else:
+            snr = self._calcSNR(appMag, magLimit)
+            vis = snr >= self.snrLimit
+        return vis, snr
+
+    def _prepH(self, ssoObs, orb, Hvals, stacker=None):
+        """
+        Like _prep, but for all of the values in Hvals at once.
+        Returns appMag (nObs, nH), magLimit (nObs, 1), vis (a boolean (nObs, nH) matrix, True where the
+        object is visible) and snr (nObs, nH) (or None if not using snrLimit).
+        If a (MoVisibilityStacker) stacker is given, these are fetched from (or computed and saved in) the stacker,
+        which must have been reset with the same ssoObs/orb/Hvals.
+        """
+        if len(ssoObs) == 0:
+            raise ValueError('No data here')
+        if stacker is not None:
+            return stacker.prepH(self)
+        appMag = self._calcAppMagH(ssoObs, orb, Hvals)
+        magLimit = self._calcMagLimit(ssoObs)[:, np.newaxis]
+        vis, snr = self._calcVisibilityH(appMag, magLimit)
+        return appMag, magLimit, vis, snr
+
     def run(self, ssoObs, orb, Hval):
         raise NotImplementedError
 
+    def runH(self, ssoObs, orb, Hvals, stacker=None):
+        """
+        Calculate the metric for each of the values in Hvals, returning an array of len(Hvals).
+        Metrics can override this to calculate all of the H values at once,
+        using the (shared) visibility calculations of the stacker if provided.
+        """
+        return np.array([self.run(ssoObs, orb, Hval) for Hval in Hvals], self.metricDtype)
+
+    def _setTimeBins(self, timeBins):
+        """
+        Set the (increasing) nights of the time bins of the time-resolved mode, or None.
+        """
+        if timeBins is not None:
+            timeBins = np.asarray(timeBins, float)
+            if timeBins.ndim != 1 or np.any(np.diff(timeBins) <= 0):
+                raise ValueError('timeBins must be a one dimensional array of increasing nights.')
+        self.timeBins = timeBins
+
+    def valueShape(self, nH):
+        """
+        Return the shape of the metric values at one slicepoint with nH Hvals:
+        (nH,), or (nH, len(timeBins)) if the metric has time bins.
+        """
+        if self.timeBins is None:
+            return (nH,)
+        return (nH, len(self.timeBins))
+
+    def _calcAppMagBatch(self, batch):
+        """
+        Calculate the apparent magnitudes (nObs, nH) of all of the observations in a batch of objects
+        (see MoSlicer.iterBatches), for each object's Hvals.
+        """
+        objIdx = batch['objIdx']
+        return (batch['obs'][self.magFilterCol][:, np.newaxis] + batch['Hvals'][objIdx]) - batch['Href'][objIdx][:, np.newaxis]
+
+    def _prepBatch(self, batch, stacker=None):
+        """
+        Like _prepH, but for all of the observations in a batch of objects (see MoSlicer.iterBatches).
+        If a stacker is given, it must have been reset with the same batch (MoVisibilityStacker.resetBatch).
+        """
+        if stacker is not None:
+            return stacker.prepBatch(self)
+        appMag = self._calcAppMagBatch(batch)
+        magLimit = self._calcMagLimit(batch['obs'])[:, np.newaxis]
+        vis, snr = self._calcVisibilityH(appMag, magLimit)
+        return appMag, magLimit, vis, snr
+
+    def runBatch(self, batch, stacker=None):
+        """
+        Calculate the metric for each object in a batch of objects (see MoSlicer.iterBatches), at each of
+        their Hvals, returning an (nObj, nH) array. Objects without observations get badval.
+        Metrics can override this to calculate the whole batch at once (see moKernels);
+        by default, this calls runH for each object in turn.
+        """
+        offsets = batch['offsets']
+        nObj, nH = batch['Hvals'].shape
+        metricValues = np.zeros((nObj,) + self.valueShape(nH), self.metricDtype) + self.badval
+        objStacker = None
+        if stacker is not None:
+            objStacker = MoVisibilityStacker(seed=stacker.seed)
+        for i, orb in enumerate(batch['orbits']):
+            ssoObs = batch['obs'][offsets[i]:offsets[i+1]]
+            if len(ssoObs) == 0:
+                continue
+            if objStacker is not None:
+                objStacker.reset(ssoObs, orb, batch['Hvals'][i])
+            metricValues[i] = self.runH(ssoObs, orb, batch['Hvals'][i], stacker=objStacker)
+        return metricValues
+
 
     def reduceCumulativeH(self, metricVals, Hvals):
         """
@@ -121,11 +254,14 @@ class BaseMoMetric(object):
         Currently supports only a single power law distribution.
         """
         self.units = '<= H'
+        metricVals = asMaskedArray(metricVals)
         # Set expected H distribution.
         # dndh = differential size distribution (number in this bin)
-        dndh = np.power(10., self.Hindex*(Hvals-Hvals.min()))
+        dndh = np.power(10., self.Hindex*(np.asarray(Hvals, float)-Hvals.min()))
+        # Broadcast over any further axes of the metric values (e.g. time bins).
+        dndh = dndh.reshape(dndh.shape + (1,)*(metricVals.ndim - 2))
         # dn = cumulative size distribution (number in this bin and brighter)
-        intVals = np.cumsum(metricVals*dndh, axis=1)/np.cumsum(dndh)
+        intVals = np.cumsum(metricVals*dndh, axis=1)/np.cumsum(dndh, axis=0)
         return intVals, Hvals
 
 
@@ -133,28 +269,58 @@ class NObsMetric(BaseMoMetric):
     """
     Count the number of observations for an object.
     """
-    def __init__(self, snrLimit=None, **kwargs):
+    def __init__(self, snrLimit=None, timeBins=None, **kwargs):
         """
         @ snrLimit .. if snrLimit is None, this uses the _calcVis method/completeness
                       if snrLimit is not None, this uses that value as a cutoff instead.
+        @ timeBins .. if not None, an increasing array of nights: count the observations before each
+                      of these nights (cumulative counts vs. time), giving one value per time bin.
         """
         super(NObsMetric, self).__init__(**kwargs)
         self.snrLimit = snrLimit
+        self._setTimeBins(timeBins)
 
     def run(self, ssoObs, orb, Hval):
+        if self.timeBins is not None:
+            try:
+                return self.runH(ssoObs, orb, [Hval])[0]
+            except ValueError:
+                return np.zeros(len(self.timeBins), self.metricDtype)
         try:
             appMag, magLimit, vis, snr = self._prep(ssoObs, orb, Hval)
             return vis.size
         except ValueError:
             return 0
 
+    def _beforeTimeBins(self, vis, nights):
+        """
+        Expand the (nObs, nH) vis matrix to (nObs, nH, nTimeBins), True where visible before each time bin night.
+        """
+        before = np.asarray(nights)[:, np.newaxis] < self.timeBins[np.newaxis, :]
+        return vis[:, :, np.newaxis] & before[:, np.newaxis, :]
+
+    def runH(self, ssoObs, orb, Hvals, stacker=None):
+        appMag, magLimit, vis, snr = self._prepH(ssoObs, orb, Hvals, stacker)
+        if self.timeBins is not None:
+            return self._beforeTimeBins(vis, ssoObs[self.nightCol]).sum(axis=0)
+        return vis.sum(axis=0)
+
+    def runBatch(self, batch, stacker=None):
+        appMag, magLimit, vis, snr = self._prepBatch(batch, stacker)
+        if self.timeBins is not None:
+            vis = self._beforeTimeBins(vis, batch['obs'][self.nightCol])
+            nObs, nH, nT = vis.shape
+            counts = moKernels.segmentCount(vis.reshape(nObs, nH * nT), batch['offsets'])
+            return counts.reshape(-1, nH, nT)
+        return moKernels.segmentCount(vis, batch['offsets'])
+
 class DiscoveryChancesMetric(BaseMoMetric):
     """
     Count the number of discovery opportunities for an object.
     """
     def __init__(self, nObsPerNight=2, tNight=90.*60.,
                  nNightsPerWindow=3, tWindow=15, snrLimit=None,
-                 requiredChances=1, **kwargs):
+                 requiredChances=1, timeBins=None, **kwargs):
         """
         @ nObsPerNight = number of observations per night required for tracklet
         @ tNight = max time start/finish for the tracklet (seconds)
@@ -162,6 +328,8 @@ class DiscoveryChancesMetric(BaseMoMetric):
         @ tWindow = max number of nights in track (days)
         @ snrLimit .. if snrLimit is None then uses 'completeness' calculation,
                    .. if snrLimit is not None, then uses this value as a cutoff.
+        @ timeBins = if not None, an increasing array of nights: count the discovery chances completed before
+                     each of these nights (cumulative chances vs. time), giving one value per time bin.
 
         Parameters for reduce method (Completeness)
         @ requiredChances = number of possible discovery chances required to count an object as 'found'
@@ -174,73 +342,65 @@ class DiscoveryChancesMetric(BaseMoMetric):
         self.nNightsPerWindow = nNightsPerWindow
         self.tWindow = tWindow
         self.requiredChances = requiredChances
+        self._setTimeBins(timeBins)
         # If H is not a cloned distribution, then we need to specify how to bin these values.
         self.nbins = 20
         self.minHrange = 1.0
 
     def run(self, ssoObs, orb, Hval):
         """SsoObs = Dataframe, orb=Dataframe, Hval=single number."""
-        # Calculate visibility for this orbit at this H.
         try:
-            appMag, magLimit, vis, snr = self._prep(ssoObs, orb, Hval)
+            return self.runH(ssoObs, orb, [Hval])[0]
         except ValueError:
+            if self.timeBins is not None:
+                return np.zeros(len(self.timeBins), self.metricDtype)
             return 0
-        # Calculate number of discovery chances.
-        if len(vis) == 0:
-            discoveryChances = 0
-        else:
-            # Now to identify where observations meet the timing requirements.
-            #  Identify visits where the 'night' changes.
-            visSort = np.argsort(ssoObs[self.nightCol])[vis]
-            n = np.unique(ssoObs[self.nightCol][visSort])
-            # Identify all the indexes where the night changes (swap from one night to next)
-            nIdx = np.searchsorted(ssoObs[self.nightCol][visSort], n)
-            # Add index pointing to last observation.
-            nIdx = np.concatenate([nIdx, np.array([len(visSort)-1])])
-            # Find the nights & indexes where there were more than nObsPerNight observations.
-            obsPerNight = (nIdx - np.roll(nIdx, 1))[1:]
-            nWithXObs = n[np.where(obsPerNight >= self.nObsPerNight)]
-            nIdxMany = np.searchsorted(ssoObs[self.nightCol][visSort], nWithXObs)
-            nIdxManyEnd = np.searchsorted(ssoObs[self.nightCol][visSort], nWithXObs, side='right') - 1
-            # Check that nObsPerNight observations are within tNight
-            timesStart = ssoObs[self.expMJDCol][visSort][nIdxMany]
-            timesEnd = ssoObs[self.expMJDCol][visSort][nIdxManyEnd]
-            # Identify the nights where the total time interval may exceed tNight
-            # (but still have a subset of nObsPerNight which are within tNight)
-            check = np.where((timesEnd - timesStart > self.tNight) & (nIdxManyEnd + 1 - nIdxMany > self.nObsPerNight))[0]
-            bad = []
-            for i, j, c in zip(visSort[nIdxMany][check], visSort[nIdxManyEnd][check], check):
-                t = ssoObs[self.expMJDCol][i:j+1]
-                dtimes = (np.roll(t, 1-nObsPerNight) - t)[:-1]
-                if np.all(dtimes > self.tNight+eps):
-                    bad.append(c)
-            goodIdx = np.delete(visSort[nIdxMany], bad)
-            # Now (with indexes of start of 'good' nights with nObsPerNight within tNight),
-            # look at the intervals between 'good' nights (for tracks)
-            if len(goodIdx) < self.nNightsPerWindow:
-                discoveryChances = 0
-            else:
-                dnights = (np.roll(ssoObs[self.nightCol][goodIdx], 1-self.nNightsPerWindow) - ssoObs[self.nightCol][goodIdx])
-                discoveryChances = len(np.where((dnights >= 0) & (dnights <= self.tWindow))[0])
-        return discoveryChances
+
+    def runH(self, ssoObs, orb, Hvals, stacker=None):
+        # Calculate visibility for this orbit at all H.
+        appMag, magLimit, vis, snr = self._prepH(ssoObs, orb, Hvals, stacker)
+        return self._discoveryChancesH(ssoObs, vis)
+
+    def runBatch(self, batch, stacker=None):
+        appMag, magLimit, vis, snr = self._prepBatch(batch, stacker)
+        return self._discoveryChances(batch['obs'], batch['offsets'], vis)
+
+    def _discoveryChancesH(self, ssoObs, vis):
+        """
+        Count the discovery chances for each column (H value) of the boolean (nObs, nH) vis matrix.
+        """
+        return self._discoveryChances(ssoObs, [0, len(ssoObs)], vis)[0]
+
+    def _discoveryChances(self, obs, offsets, vis):
+        """
+        Count the discovery chances of each object (observations obs[offsets[i]:offsets[i+1]]), for each
+        column (H value) of vis. A night has a tracklet if it has (at least) nObsPerNight visible observations
+        within tNight, and each set of nNightsPerWindow nights with tracklets within tWindow days is a
+        discovery chance. With timeBins, each chance counts in the time bins after the last night of its track.
+        """
+        # tNight is in seconds, the observation times in days.
+        discoveryChances = moKernels.discoveryChances(obs[self.nightCol], obs[self.expMJDCol], offsets, vis,
+                                                      self.nObsPerNight, self.tNight / 86400.0,
+                                                      self.nNightsPerWindow, self.tWindow, self.timeBins)
+        return discoveryChances.astype(self.metricDtype)
 
     def reduceCompleteness(self, discoveryChances, Hvals):
         """
         Take the discoveryChances metric results and turn it into
         completeness estimate (relative to the entire population).
         Require at least 'requiredChances' to count an object as "found".
+        With timeBins, this gives the completeness at each H in each time bin (completeness vs. time).
         """
+        discoveryChances = asMaskedArray(discoveryChances)
         nSsos = discoveryChances.shape[0]
         nHval = len(Hvals)
-        discoveriesH = discoveryChances.swapaxes(0, 1)
+        found = discoveryChances.filled(0) >= self.requiredChances
         if nHval == discoveryChances.shape[1]:
             # Hvals array is probably the same as the cloned H array.
-            completeness = ma.MaskedArray(data = np.zeros([1, nHval], float),
-                                          mask = np.zeros([1, nHval], 'bool'),
+            nFound = found.sum(axis=0)[np.newaxis]
+            completeness = ma.MaskedArray(data = nFound / float(nSsos),
+                                          mask = np.zeros(nFound.shape, 'bool'),
                                           fill_value = 0.0)
-            for i, H in enumerate(Hvals):
-                completeness.data[0][i] = np.where(discoveriesH[i].filled(0) >= self.requiredChances)[0].size
-            completeness = completeness / float(nSsos)
         else:
             # The Hvals are spread more randomly among the objects (we probably used one per object).
             hrange = Hvals.max() - Hvals.min()
@@ -250,15 +410,19 @@ class DiscoveryChancesMetric(BaseMoMetric):
                 minH = Hvals.min() - hrange/2.0
             stepsize = hrange / float(self.nbins)
             bins = np.arange(minH, minH + hrange + stepsize/2.0, stepsize)
+            n_all, b = np.histogram(Hvals, bins)
+            # Count the found objects in each H bin, separately for each time bin (if any).
+            foundObj = found[:, 0]
+            extraShape = foundObj.shape[1:]
+            foundObj = foundObj.reshape(nSsos, -1)
+            n_found = np.array([np.histogram(Hvals[f], bins)[0] for f in foundObj.T]).T
+            n_found = n_found.reshape((len(n_all),) + extraShape)
+            n_all = n_all.reshape(n_all.shape + (1,)*len(extraShape))
             Hvals = bins[:-1]
-            n_all, b = np.histogram(discoveriesH[0], bins)
-            condition = np.where(discoveriesH[0] >= self.requiredChances)[0]
-            n_found, b = np.histogram(discoveriesH[0][condition], bins)
-            completeness = ma.MaskedArray(data = np.zeros([1, len(Hvals)], float),
-                                          mask = np.zeros([1, len(Hvals)], bool),
+            data = n_found.astype(float) / np.where(n_all == 0, 1, n_all).astype(float)
+            completeness = ma.MaskedArray(data = data[np.newaxis],
+                                          mask = (np.zeros(data.shape, bool) | (n_all == 0))[np.newaxis],
                                           fill_value = 0.0)
-            completeness.data[0] = n_found.astype(float) / n_all.astype(float)
-            completeness.mask[0] = np.where(n_all==0, True, False)
         return completeness, Hvals
 
 
@@ -293,6 +457,20 @@ class ActivityOverTimeMetric(BaseMoMetric):
             activityWindows = np.where(n>0)[0].size
         return activityWindows / float(nWindows)
 
+    def runH(self, ssoObs, orb, Hvals, stacker=None):
+        windowBins = np.arange(0, self.surveyYears*365 + self.window/2.0, self.window)
+        nWindows = len(windowBins)
+        appMag, magLimit, vis, snr = self._prepH(ssoObs, orb, Hvals, stacker)
+        activityWindows = moKernels.countOccupiedBins(ssoObs[self.nightCol], [0, len(ssoObs)], windowBins, vis)[0]
+        return activityWindows / float(nWindows)
+
+    def runBatch(self, batch, stacker=None):
+        windowBins = np.arange(0, self.surveyYears*365 + self.window/2.0, self.window)
+        nWindows = len(windowBins)
+        appMag, magLimit, vis, snr = self._prepBatch(batch, stacker)
+        activityWindows = moKernels.countOccupiedBins(batch['obs'][self.nightCol], batch['offsets'], windowBins, vis)
+        return activityWindows / float(nWindows)
+
 
 class ActivityOverPeriodMetric(BaseMoMetric):
     """
@@ -301,7 +479,7 @@ class ActivityOverPeriodMetric(BaseMoMetric):
     """
     def __init__(self, window, snrLimit=5, nBins=10,
                  aCol='a', tPeriCol='tPeri', **kwargs):
-        super(ActivityOverPeriodMetric, self).__init(**kwargs)
+        super(ActivityOverPeriodMetric, self).__init__(**kwargs)
         self.aCol = aCol
         self.tPeriCol = tPeriCol
         self.snrLimit = snrLimit
@@ -324,4 +502,25 @@ class ActivityOverPeriodMetric(BaseMoMetric):
         else:
             n, b = np.histogram(anomaly[vis], bins=anomalyBins)
             activityWindows = np.where(n>0)[0].size
-        return activityWindows / float(nBins)
+        return activityWindows / float(self.nBins)
+
+    def runH(self, ssoObs, orb, Hvals, stacker=None):
+        period = np.power(orb[self.aCol], 3./2.) * 365.25
+        anomaly = ((ssoObs[self.expMJDCol] - orb[self.tPeriCol]) / period) % (2*np.pi)
+        binsize = 2*np.pi / float(self.nBins)
+        anomalyBins = np.arange(0, 2*np.pi + binsize/2.0, binsize)
+        appMag, magLimit, vis, snr = self._prepH(ssoObs, orb, Hvals, stacker)
+        activityWindows = moKernels.countOccupiedBins(anomaly, [0, len(ssoObs)], anomalyBins, vis)[0]
+        return activityWindows / float(self.nBins)
+
+    def runBatch(self, batch, stacker=None):
+        objIdx = batch['objIdx']
+        a = np.array([orb[self.aCol] for orb in batch['orbits']], float)
+        tPeri = np.array([orb[self.tPeriCol] for orb in batch['orbits']], float)
+        period = np.power(a, 3./2.) * 365.25
+        anomaly = ((batch['obs'][self.expMJDCol] - tPeri[objIdx]) / period[objIdx]) % (2*np.pi)
+        binsize = 2*np.pi / float(self.nBins)
+        anomalyBins = np.arange(0, 2*np.pi + binsize/2.0, binsize)
+        appMag, magLimit, vis, snr = self._prepBatch(batch, stacker)
+        activityWindows = moKernels.countOccupiedBins(anomaly, batch['offsets'], anomalyBins, vis)
+        return activityWindows / float(self.nBins)
@@ -1,10 +1,12 @@
 import os
 import numpy as np
 import pandas as pd
+import healpy as hp
 
 from itertools import repeat
+from multiprocessing import Pool
 import pyoorb as oo
-from scipy import interpolate
+from moObsIO import getObsWriter, guessObsFormat, mergeObsFiles, _openTempFile, _readStamped, _checkCacheInfo
 
 import lsst.sims.photUtils.Bandpass as Bandpass
 import lsst.sims.photUtils.Sed as Sed
@@ -13,7 +15,8 @@ from lsst.sims.utils import haversine, ObservationMetaData
 from lsst.obs.lsstSim import LsstSimMapper
 from lsst.sims.coordUtils import findChipName, observedFromICRS
 
-__all__ = ['MoOrbits', 'MoObs', 'runMoObs']
+__all__ = ['MoOrbits', 'orbitCacheFile', 'writeOrbitCache', 'readOrbitCache',
+           'EphInterpolator', 'PointingIndex', 'CameraFootprint', 'MoObs', 'runMoObs']
 
 class MoOrbits(object):
     """
@@ -36,13 +39,30 @@ class MoOrbits(object):
                 colMap[outCol] = a
         return colMap
 
-    def readOrbits(self, orbitfile):
+    def readOrbits(self, orbitfile, useCache=False, columns=None):
         """
-        Read the orbits from file 'orbitfile', generating a numpy structured array with the columns:
+        Read the orbits from file 'orbitfile', generating a pandas DataFrame with the columns:
         'objID q e inc node argPeri tPeri epoch H g a meanAnom'
+        @ useCache : if True, read the (normalized) orbits from a binary cache of orbitfile instead of parsing it
+           (see readOrbitCache); the cache is written the first time, and rewritten whenever orbitfile changes.
+        @ columns : if not None, only keep these columns (plus objId). With the cache, only these columns are read.
         """
         self.orbitfile = orbitfile
-        orbits = pd.read_table(orbitfile, delim_whitespace=True)
+        if columns is not None:
+            columns = ['objId'] + [col for col in columns if col != 'objId']
+        if useCache:
+            self.orbits = readOrbitCache(orbitfile, columns)
+        else:
+            self.orbits = self._normalizeOrbits(pd.read_table(orbitfile, delim_whitespace=True))
+            if columns is not None:
+                self.orbits = self.orbits[columns]
+        self.ssoIds = np.unique(self.orbits['objId'])
+        self.nSso = len(self.ssoIds)
+
+    def _normalizeOrbits(self, orbits):
+        """
+        Convert the orbits read from an orbit file (a DataFrame) to the standard columns, generating any missing ones.
+        """
         # Normalize the column names, as different inputs tend to have some commonly-different names.
         ssoCols = orbits.columns.values.tolist()
         nSso = len(orbits)
@@ -119,7 +139,7 @@ class MoOrbits(object):
             tPerival = orbits[colMap['tPeri']]
 
         # Put it all together into a dataframe.
-        self.orbits = pd.DataFrame({'objId':orbids,
+        return pd.DataFrame({'objId':orbids,
                                     'q':qval,
                                     'e':orbits[colMap['e']],
                                     'inc':orbits[colMap['inc']],
@@ -131,8 +151,296 @@ class MoOrbits(object):
                                     'g':gval,
                                     'a':aval,
                                     'M':meanAnomval})
-        self.ssoIds = np.unique(self.orbits['objId'])
-        self.nSso = len(self.ssoIds)
+
+
+def orbitCacheFile(orbitfile):
+    """
+    Return the name of the file caching the normalized orbits of orbitfile.
+    """
+    return orbitfile + '.cache.npz'
+
+
+def _saveOrbitCache(cachefile, arrays, info):
+    """
+    Save arrays (the columns of the orbits, and their names as '_columns') and the cache information
+    (see moObsIO._cacheInfo) to cachefile, as a binary numpy (npz) file.
+    """
+    # Write to a (uniquely named) temporary file and then rename, so other processes never see a partial cache.
+    f, tmpname = _openTempFile(cachefile)
+    with f:
+        np.savez(f, _info=info, **arrays)
+    os.rename(tmpname, cachefile)
+
+
+def writeOrbitCache(orbitfile):
+    """
+    Parse and normalize the orbits in orbitfile (as MoOrbits.readOrbits) and save them as a binary numpy (npz) file,
+    one (fixed dtype) array per column, together with the stamp and the hash of the contents of orbitfile.
+    """
+    orbits, info = _readStamped(orbitfile,
+                                lambda filename: MoOrbits()._normalizeOrbits(pd.read_table(filename,
+                                                                                          delim_whitespace=True)))
+    arrays = {'_columns': np.array(list(orbits.columns))}
+    for col in orbits.columns:
+        values = orbits[col].values
+        # Convert any object (string) columns to fixed length strings.
+        if values.dtype == object:
+            maxLength = max([len(str(x)) for x in values] + [1])
+            values = values.astype('S%d' %(maxLength))
+        arrays[col] = values
+    _saveOrbitCache(orbitCacheFile(orbitfile), arrays, info)
+
+
+def readOrbitCache(orbitfile, columns=None):
+    """
+    Return the normalized orbits of orbitfile (a DataFrame, as MoOrbits.readOrbits) from its binary cache,
+    reading only the requested columns (if not None).
+    The cache is (re)written first if it does not exist or if the contents of orbitfile have changed.
+    (The contents are only hashed again if the stamp of orbitfile has changed; if they have not changed,
+    the cache is restamped.)
+    """
+    cachefile = orbitCacheFile(orbitfile)
+    current = False
+    if os.path.isfile(cachefile):
+        cache = np.load(cachefile)
+        # Caches without the cache information are an older format, and are rewritten.
+        if '_info' in cache.files:
+            current, newInfo = _checkCacheInfo(orbitfile, cache['_info'])
+            if current and newInfo is not None:
+                arrays = dict([(key, cache[key]) for key in cache.files if key != '_info'])
+                _saveOrbitCache(cachefile, arrays, newInfo)
+        cache.close()
+    if not current:
+        writeOrbitCache(orbitfile)
+    # The arrays of the npz file are only read when accessed.
+    cache = np.load(cachefile)
+    if columns is None:
+        columns = [str(col) for col in cache['_columns']]
+    data = {}
+    for col in columns:
+        values = cache[col]
+        if values.dtype.kind == 'S':
+            values = values.astype(object)
+        data[col] = values
+    cache.close()
+    return pd.DataFrame(data, columns=columns)
+
+
+class EphInterpolator(object):
+    """
+    Linear interpolation of the ephemerides of a set of objects over time.
+    All columns of the (nObj, nTimes) ephemeris grid are held in one contiguous array,
+    so that many columns can be evaluated for many objects at many times in a single pass.
+    """
+    def __init__(self, ephs):
+        """
+        @ ephs : numpy recarray of ephemerides, shaped (nObj, nTimes) (as returned by MoObs.generateEphs).
+        All objects must share the same ephemeris times.
+        """
+        if len(ephs.shape) == 1:
+            ephs = ephs.reshape(1, len(ephs))
+        self.names = list(ephs.dtype.names)
+        self.cols = [n for n in self.names if n != 'time']
+        self.nObj = ephs.shape[0]
+        self.times = np.array(ephs['time'][0], float)
+        # grid[column, object, time]
+        self.grid = np.empty((len(self.cols), self.nObj, len(self.times)), float)
+        for i, n in enumerate(self.cols):
+            self.grid[i] = ephs[n]
+        self.colIdx = dict([(n, i) for i, n in enumerate(self.cols)])
+
+    def interpolate(self, times, objIdx=0, cols=None):
+        """
+        Return a recarray of the interpolated ephemeris columns 'cols' (default, all) plus 'time'.
+        @ times : the times at which to evaluate the ephemerides.
+        @ objIdx : the index of the object (in the ephemeris grid) to evaluate at all 'times',
+                   or an array of object indexes (one per value in 'times').
+        """
+        times = np.asarray(times, float)
+        if times.size > 0 and (times.min() < self.times[0] or times.max() > self.times[-1]):
+            raise ValueError('Interpolation times outside the range of the ephemeris times.')
+        if cols is None:
+            cols = self.cols
+        cols = [n for n in self.names if n in cols and n != 'time']
+        cIdx = np.array([self.colIdx[n] for n in cols], int)[:, np.newaxis]
+        # Find the grid points bracketing each time (as in scipy's interp1d).
+        hi = np.clip(np.searchsorted(self.times, times), 1, len(self.times) - 1)
+        lo = hi - 1
+        ylo = self.grid[cIdx, objIdx, lo]
+        yhi = self.grid[cIdx, objIdx, hi]
+        slope = (yhi - ylo) / (self.times[hi] - self.times[lo])
+        vals = slope * (times - self.times[lo]) + ylo
+        arrays = []
+        names = []
+        for n in self.names:
+            if n == 'time':
+                arrays.append(times)
+            elif n in cols:
+                arrays.append(vals[cols.index(n)])
+            else:
+                continue
+            names.append(n)
+        return np.rec.fromarrays(arrays, names=names)
+
+
+class PointingIndex(object):
+    """
+    Index of the opsim pointings (simdata) by time and by sky position, so that the visits
+    near an object's track can be found without checking every visit in the survey.
+    Visits are binned in time on the ephemeris time grid and on the sky in HEALPix pixels
+    (by boresight position), then sorted on the combined (time bin, pixel) key.
+    Build once and reuse for all objects.
+    """
+    def __init__(self, simdata, times, nside=8,
+                 simdataRaCol='fieldRA', simdataDecCol='fieldDec'):
+        """
+        @ simdata : the opsim visits.
+        @ times : the ephemeris time grid (days), i.e. the times in the EphInterpolator.
+        @ nside : HEALPix nside used to index the boresight positions.
+        """
+        self.times = np.asarray(times, float)
+        self.nBins = len(self.times) - 1
+        self.nside = nside
+        self.npix = hp.nside2npix(nside)
+        # Search radius (radians) up to which the visits of a time bin are found from the pixels near the object;
+        # time bins with a larger search radius are searched in full.
+        self.maxRadius = hp.nside2resol(nside) / 2.0
+        # The pixels which could contain a point within maxRadius of any point in each pixel. Every point of
+        # a pixel is within max_pixrad of its center, so a point within maxRadius of a point in the pixel is within
+        # maxRadius + max_pixrad of its center, and the pixel containing that point has its center within
+        # maxRadius + 2*max_pixrad. (query_disc's inclusive mode is not conservative at low nside.)
+        centers = np.array(hp.pix2vec(nside, np.arange(self.npix))).T
+        discs = [hp.query_disc(nside, center, self.maxRadius + 2.0 * hp.max_pixrad(nside)) for center in centers]
+        # Store each set of pixels as the runs [discLo, discHi) of consecutive (ring ordered) pixel numbers,
+        # padded with empty runs.
+        runs = []
+        for disc in discs:
+            disc = np.sort(disc)
+            breaks = np.flatnonzero(np.diff(disc) != 1) + 1
+            runs.append((disc[np.concatenate([[0], breaks])], disc[np.concatenate([breaks - 1, [len(disc) - 1]])] + 1))
+        nRuns = max([len(lo) for lo, hi in runs])
+        self.discLo = np.zeros((self.npix, nRuns), 'int64')
+        self.discHi = np.zeros((self.npix, nRuns), 'int64')
+        for p, (lo, hi) in enumerate(runs):
+            self.discLo[p, :len(lo)] = lo
+            self.discHi[p, :len(hi)] = hi
+        tBin = np.searchsorted(self.times, simdata['expMJD'], side='right') - 1
+        # Visits at the last ephemeris time belong to the last time bin.
+        tBin[np.asarray(simdata['expMJD']) == self.times[-1]] = self.nBins - 1
+        pix = hp.ang2pix(nside, np.pi/2.0 - simdata[simdataDecCol], simdata[simdataRaCol])
+        keys = tBin.astype('int64') * self.npix + pix
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+
+    def candidates(self, interp, radius, ephIdx=0):
+        """
+        Return the (sorted) indexes of the simdata visits whose boresight could be within 'radius'
+        (radians) of the object at the time of the visit.
+        @ interp : EphInterpolator for the object(s), on the same time grid as the index.
+        @ ephIdx : the index of the object within interp.
+        """
+        if len(interp.times) != len(self.times):
+            raise ValueError('The ephemeris times of interp do not match the times of the PointingIndex.')
+        # The interpolated track within each time bin is a straight line (in ra/dec) between the grid points,
+        # so it stays within (dRa + dDec)/2 of the position at the middle of the bin.
+        raNode = np.radians(interp.grid[interp.colIdx['ra'], ephIdx])
+        decNode = np.radians(interp.grid[interp.colIdx['dec'], ephIdx])
+        raMid = (raNode[1:] + raNode[:-1]) / 2.0
+        decMid = (decNode[1:] + decNode[:-1]) / 2.0
+        rBin = radius + (np.abs(np.diff(raNode)) + np.abs(np.diff(decNode))) / 2.0
+        bins = np.arange(self.nBins, dtype='int64')
+        # Bins where the object moves too far to use the pixels near the object are searched in full.
+        wide = np.where(rBin > self.maxRadius)[0]
+        narrow = np.where(rBin <= self.maxRadius)[0]
+        theta = np.pi/2.0 - decMid[narrow]
+        phi = raMid[narrow] % (2.0*np.pi)
+        pix = hp.ang2pix(self.nside, theta, phi)
+        binKeys = bins[narrow][:, np.newaxis] * self.npix
+        keysLo = np.concatenate([(binKeys + self.discLo[pix]).ravel(), bins[wide] * self.npix])
+        keysHi = np.concatenate([(binKeys + self.discHi[pix]).ravel(), (bins[wide] + 1) * self.npix])
+        start = np.searchsorted(self.keys, keysLo, side='left')
+        stop = np.searchsorted(self.keys, keysHi, side='left')
+        # Gather all of the (non-overlapping) ranges of the sorted keys.
+        nInRange = stop - start
+        use = np.where(nInRange > 0)[0]
+        if len(use) == 0:
+            return np.array([], int)
+        offsets = np.cumsum(nInRange[use])
+        positions = np.arange(offsets[-1]) + np.repeat(start[use] - offsets + nInRange[use], nInRange[use])
+        return np.sort(self.order[positions])
+
+
+class CameraFootprint(object):
+    """
+    Lookup table of the camera chip footprint, in focal-plane (tangent-plane) coordinates.
+    The footprint is sampled once with findChipName on a grid around a reference pointing (with rotSkyPos=0);
+    afterwards any set of positions, for any set of visits, is tested by projecting the positions onto the
+    tangent plane of each visit's boresight, rotating by rotSkyPos, and looking up the grid.
+    This ignores the (small) variation of refraction and aberration with pointing.
+    """
+    def __init__(self, camera, fov=np.radians(2.1), resolution=np.radians(10./3600.),
+                 epoch=2000.0, mjd=49353., nRowsPerCall=100):
+        """
+        @ camera : the camera (from the LsstSimMapper).
+        @ fov : half-width (radians) of the region to sample.
+        @ resolution : spacing (radians) of the lookup table grid.
+        """
+        self.fov = fov
+        self.resolution = resolution
+        self.nGrid = int(np.ceil(2.0 * fov / resolution)) + 1
+        grid = np.arange(self.nGrid) * resolution - fov
+        # Reference pointing on the equator, away from the ra=0 wrap.
+        ra0 = np.pi
+        dec0 = 0.0
+        obs_metadata = ObservationMetaData(unrefractedRA=np.degrees(ra0), unrefractedDec=np.degrees(dec0),
+                                           rotSkyPos=0.0, mjd=mjd)
+        self.onChip = np.zeros((self.nGrid, self.nGrid), bool)
+        # Sample the footprint a few rows (of constant eta) at a time, to limit memory use.
+        for rowStart in range(0, self.nGrid, nRowsPerCall):
+            eta, xi = np.meshgrid(grid[rowStart:rowStart + nRowsPerCall], grid, indexing='ij')
+            ra, dec = self._fromTangentPlane(xi.ravel(), eta.ravel(), ra0, dec0)
+            raObs, decObs = observedFromICRS(ra, dec, obs_metadata=obs_metadata, epoch=epoch)
+            chipNames = findChipName(ra=raObs, dec=decObs, epoch=epoch, camera=camera, obs_metadata=obs_metadata)
+            onChip = np.array([c is not None for c in chipNames], bool)
+            self.onChip[rowStart:rowStart + nRowsPerCall] = onChip.reshape(eta.shape)
+
+    def _fromTangentPlane(self, xi, eta, ra0, dec0):
+        """
+        Convert tangent-plane coordinates (radians) around (ra0, dec0) to ra/dec (radians).
+        """
+        denom = np.cos(dec0) - eta * np.sin(dec0)
+        ra = ra0 + np.arctan2(xi, denom)
+        dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.sqrt(xi**2 + denom**2))
+        return ra, dec
+
+    def _toTangentPlane(self, ra, dec, ra0, dec0):
+        """
+        Convert ra/dec (radians) to tangent-plane coordinates (radians) around (ra0, dec0).
+        """
+        cosd = np.cos(dec)
+        cosdra = np.cos(ra - ra0)
+        denom = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * cosd * cosdra
+        xi = cosd * np.sin(ra - ra0) / denom
+        eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * cosd * cosdra) / denom
+        return xi, eta, denom
+
+    def inFootprint(self, ra, dec, raBore, decBore, rotSkyPos):
+        """
+        Return a boolean array, True where (ra, dec) lands on a chip for the visit with boresight
+        (raBore, decBore) and rotation rotSkyPos (all radians, all arrays of the same length).
+        """
+        xi, eta, denom = self._toTangentPlane(ra, dec, raBore, decBore)
+        # Rotate into the camera frame (rotSkyPos = position angle of the camera +y axis, east of north).
+        cosr = np.cos(rotSkyPos)
+        sinr = np.sin(rotSkyPos)
+        x = xi * cosr - eta * sinr
+        y = eta * cosr + xi * sinr
+        ix = np.round((x + self.fov) / self.resolution).astype(int)
+        iy = np.round((y + self.fov) / self.resolution).astype(int)
+        inGrid = (denom > 0) & (ix >= 0) & (ix < self.nGrid) & (iy >= 0) & (iy < self.nGrid)
+        result = np.zeros(len(ra), bool)
+        result[inGrid] = self.onChip[iy[inGrid], ix[inGrid]]
+        return result
 
 
 class MoObs(MoOrbits):
@@ -276,17 +584,12 @@ class MoObs(MoOrbits):
         return ephs
 
     # Linear interpolation
-    def interpolateEphs(self, ephs, i=0):
+    def interpolateEphs(self, ephs):
         """
-        Generate linear interpolations between the quantities in ephs over time.
+        Generate linear interpolations between the quantities in ephs over time,
+        for all of the objects in ephs.
         """
-        interpfuncs = {}
-        for n in ephs.dtype.names:
-            if n == 'time':
-                continue
-            interpfuncs[n] = interpolate.interp1d(ephs['time'][i], ephs[n][i], kind='linear',
-                                                  assume_sorted=True, copy=False)
-        return interpfuncs
+        return EphInterpolator(ephs)
 
     def _setupCamera(self):
         """
@@ -297,41 +600,133 @@ class MoObs(MoOrbits):
         self.epoch = 2000.0
         self.cameraFov=np.radians(2.1)
 
-    def ssoInFov(self, interpfuncs, simdata, rFov=np.radians(1.75),
+    def setupCameraFootprint(self, resolution=np.radians(10./3600.)):
+        """
+        Precompute a chip lookup table (CameraFootprint), to use in place of findChipName
+        when testing the camera footprint.
+        """
+        try:
+            self.camera
+        except AttributeError:
+            self._setupCamera()
+        self.cameraFootprint = CameraFootprint(self.camera, fov=self.cameraFov, resolution=resolution,
+                                               epoch=self.epoch)
+
+    def _ssoNearBoresight(self, interp, simdata, radius, ephIdx=0, pointingIndex=None,
+                          simdataRaCol='fieldRA', simdataDecCol='fieldDec'):
+        """
+        Return the indexes of the simdata observations where the object was within 'radius' of the
+        boresight, together with the ra/dec (radians) of the object at those times.
+        """
+        # Choose the visits to check.
+        if pointingIndex is None:
+            idxCand = np.arange(len(simdata))
+            tvis = simdata['expMJD']
+            raVis = simdata[simdataRaCol]
+            decVis = simdata[simdataDecCol]
+        else:
+            idxCand = pointingIndex.candidates(interp, radius, ephIdx)
+            tvis = simdata['expMJD'][idxCand]
+            raVis = simdata[simdataRaCol][idxCand]
+            decVis = simdata[simdataDecCol][idxCand]
+        pos = interp.interpolate(tvis, ephIdx, cols=['ra', 'dec'])
+        raSso = np.radians(pos['ra'])
+        decSso = np.radians(pos['dec'])
+        sep = haversine(raSso, decSso, raVis, decVis)
+        close = np.where(sep<radius)[0]
+        return idxCand[close], raSso[close], decSso[close]
+
+    def _inCameraFootprint(self, idxObs, raSso, decSso, simdata,
+                           simdataRaCol='fieldRA', simdataDecCol='fieldDec'):
+        """
+        Return a boolean array, True where the object position (raSso/decSso, radians) at
+        visit simdata[idxObs] falls on a chip.
+        idxObs can include many objects (and repeated visits); all positions within the same visit
+        are evaluated together.
+        """
+        onChip = np.zeros(len(idxObs), bool)
+        if len(idxObs) == 0:
+            return onChip
+        try:
+            self.cameraFootprint
+        except AttributeError:
+            self.cameraFootprint = None
+        if self.cameraFootprint is not None:
+            # Use the precomputed chip lookup table, for all visits at once.
+            visits = simdata[idxObs]
+            onChip = self.cameraFootprint.inFootprint(raSso, decSso, visits[simdataRaCol],
+                                                      visits[simdataDecCol], visits['rotSkyPos'])
+            return onChip
+        # Group by visit, and use findChipName for all positions in each visit.
+        order = np.argsort(idxObs, kind='mergesort')
+        visits, starts = np.unique(idxObs[order], return_index=True)
+        ends = np.concatenate([starts[1:], [len(order)]])
+        for idx, start, end in zip(visits, starts, ends):
+            match = order[start:end]
+            obs_metadata = ObservationMetaData(unrefractedRA=np.degrees(simdata[idx][simdataRaCol]),
+                                               unrefractedDec=np.degrees(simdata[idx][simdataDecCol]),
+                                               rotSkyPos=np.degrees(simdata[idx]['rotSkyPos']),
+                                               mjd=simdata[idx]['expMJD'])
+            raObj, decObj = observedFromICRS(raSso[match], decSso[match], obs_metadata=obs_metadata, epoch=self.epoch)
+            chipNames = findChipName(ra=raObj,dec=decObj, epoch=self.epoch, camera=self.camera, obs_metadata=obs_metadata)
+            onChip[match] = [c is not None for c in chipNames]
+        return onChip
+
+    def ssoInFov(self, interp, simdata, rFov=np.radians(1.75),
                  useCamera=True,
-                 simdataRaCol = 'fieldRA', simdataDecCol='fieldDec'):
+                 simdataRaCol = 'fieldRA', simdataDecCol='fieldDec', ephIdx=0,
+                 pointingIndex=None):
         """
         Return the indexes of the simdata observations where the object was inside the fov.
+        @ interp : EphInterpolator for the object(s), from interpolateEphs.
+        @ ephIdx : the index of the object within interp.
+        @ pointingIndex : optional PointingIndex of simdata; if provided, only the visits near the
+                          object's track are checked.
         """
         # See if the object is within 'rFov' of the center of the boresight.
-        raSso = np.radians(interpfuncs['ra'](simdata['expMJD']))
-        decSso = np.radians(interpfuncs['dec'](simdata['expMJD']))
-        sep = haversine(raSso, decSso, simdata[simdataRaCol], simdata[simdataDecCol])
         if not useCamera:
-            idxObsRough = np.where(sep<rFov)[0]
+            idxObsRough, raSso, decSso = self._ssoNearBoresight(interp, simdata, rFov, ephIdx, pointingIndex,
+                                                                simdataRaCol, simdataDecCol)
             return idxObsRough
         # Or go on and use the camera footprint.
         try:
             self.camera
         except AttributeError:
             self._setupCamera()
-        idxObs = []
-        idxObsRough = np.where(sep<self.cameraFov)[0]
-        for idx in idxObsRough:
-            mjd = simdata[idx]['expMJD']
-            obs_metadata = ObservationMetaData(unrefractedRA=np.degrees(simdata[idx][simdataRaCol]),
-                                               unrefractedDec=np.degrees(simdata[idx][simdataDecCol]),
-                                               rotSkyPos=np.degrees(simdata[idx]['rotSkyPos']),
-                                               mjd=simdata[idx]['expMJD'])
-            raObj = np.radians(np.array([interpfuncs['ra'](simdata[idx]['expMJD'])]))
-            decObj = np.radians(np.array([interpfuncs['dec'](simdata[idx]['expMJD'])]))
-            raObj, decObj = observedFromICRS(raObj, decObj, obs_metadata=obs_metadata, epoch=self.epoch)
-            chipNames = findChipName(ra=raObj,dec=decObj, epoch=self.epoch, camera=self.camera, obs_metadata=obs_metadata)
-            if chipNames != [None]:
-                idxObs.append(idx)
-        idxObs = np.array(idxObs)
+        idxObsRough, raSso, decSso = self._ssoNearBoresight(interp, simdata, self.cameraFov, ephIdx, pointingIndex,
+                                                            simdataRaCol, simdataDecCol)
+        onChip = self._inCameraFootprint(idxObsRough, raSso, decSso, simdata, simdataRaCol, simdataDecCol)
+        idxObs = idxObsRough[onChip]
         return idxObs
 
+    def ssoInFovBlock(self, interp, simdata, rFov=np.radians(1.75),
+                      useCamera=True,
+                      simdataRaCol = 'fieldRA', simdataDecCol='fieldDec',
+                      pointingIndex=None):
+        """
+        Return a list (one entry per object in interp) of the indexes of the simdata observations
+        where each object was inside the fov.
+        With the camera footprint, the candidate detections of all objects are tested together, grouped by visit.
+        """
+        if not useCamera:
+            return [self.ssoInFov(interp, simdata, rFov=rFov, useCamera=False, simdataRaCol=simdataRaCol,
+                                  simdataDecCol=simdataDecCol, ephIdx=i, pointingIndex=pointingIndex)
+                    for i in range(interp.nObj)]
+        try:
+            self.camera
+        except AttributeError:
+            self._setupCamera()
+        rough = [self._ssoNearBoresight(interp, simdata, self.cameraFov, i, pointingIndex,
+                                        simdataRaCol, simdataDecCol) for i in range(interp.nObj)]
+        nRough = [len(r[0]) for r in rough]
+        idxObsRough = np.concatenate([r[0] for r in rough]).astype(int)
+        raSso = np.concatenate([r[1] for r in rough])
+        decSso = np.concatenate([r[2] for r in rough])
+        onChip = self._inCameraFootprint(idxObsRough, raSso, decSso, simdata, simdataRaCol, simdataDecCol)
+        idxObs = np.split(idxObsRough, np.cumsum(nRough)[:-1])
+        onChip = np.split(onChip, np.cumsum(nRough)[:-1])
+        return [i[o] for i, o in zip(idxObs, onChip)]
+
 
     def _calcColors(self, sedname='C.dat'):
         """
@@ -374,32 +769,40 @@ class MoObs(MoOrbits):
         dmagDetect = 1.25 * np.log10(1 + a_det*x**2 / (1+b_det*x))
         return dmagTrail, dmagDetect
 
-    def _openOutput(self, outfileName):
-        self.outfile = open(outfileName, 'w')
-        self.wroteHeader = False
+    def _openOutput(self, outfileName, obsFormat=None):
+        self.obsWriter = getObsWriter(outfileName, obsFormat)
+
+    def _closeOutput(self):
+        """
+        Close the output file (if one was opened), so that the next call to writeObs opens a new file.
+        """
+        try:
+            self.obsWriter.close()
+            del self.obsWriter
+        except AttributeError:
+            pass
 
-    def writeObs(self, objId, interpfuncs, simdata, idxObs, outfileName='out.txt',
+    def writeObs(self, objId, interp, simdata, idxObs, outfileName='out.txt',
                  sedname='C.dat', tol=1e-8,
-                 seeingCol='finSeeing', expTimeCol='visitExpTime'):
+                 seeingCol='finSeeing', expTimeCol='visitExpTime', ephIdx=0, obsFormat=None):
         """
         Call for each object; write out the observations of each object.
+        @ interp : EphInterpolator for the object(s), from interpolateEphs.
+        @ ephIdx : the index of the object within interp.
+        @ obsFormat : output format (one of moObsIO.obsWriters: 'text' or 'hdf').
+                      Default is chosen from the outfileName extension ('.h5' or '.hdf5' = hdf).
         """
         # Return if there's nothing to write out.
         if len(idxObs) == 0:
             return
         # Open file if needed.
         try:
-            self.outfile
+            self.obsWriter
         except AttributeError:
-            self._openOutput(outfileName)
-        # Calculate the ephemerides for the object, using the interpfuncs, for the times in simdata[idxObs].
+            self._openOutput(outfileName, obsFormat)
+        # Calculate the ephemerides for the object, using the interpolator, for the times in simdata[idxObs].
         tvis = simdata['expMJD'][idxObs]
-        ephs = np.recarray([len(tvis)], dtype=([('delta', '<f8'), ('ra', '<f8'), ('dec', '<f8'),
-                                                ('magV', '<f8'), ('time', '<f8'), ('dradt', '<f8'), ('ddecdt', '<f8'),
-                                                ('phase', '<f8'), ('solarelon', '<f8'), ('velocity', '<f8')]))
-        for n in interpfuncs:
-            ephs[n] = interpfuncs[n](tvis)
-        ephs['time'] = tvis
+        ephs = interp.interpolate(tvis, ephIdx)
         # Calculate the extra columns we want to write out (dmag due to color, trailing loss, and detection loss)
         # First calculate and match the color dmag term.
         dmagColor = np.zeros(len(idxObs), float)
@@ -418,44 +821,110 @@ class MoObs(MoOrbits):
         dmags = np.rec.fromarrays([magFilter, dmagColor, dmagTrail, dmagDetect],
                                   names=['magFilter', 'dmagColor', 'dmagTrail', 'dmagDetect'])
 
-        outCols = ['objId',] + list(ephs.dtype.names) + list(simdata.dtype.names) + list(dmags.dtype.names)
+        # Combine all of the output columns and pass them to the writer.
+        simdat = simdata[idxObs]
+        outCols = ['objId',] + list(ephs.dtype.names) + list(simdat.dtype.names) + list(dmags.dtype.names)
+        outArrays = ([np.repeat(objId, len(idxObs))] + [ephs[col] for col in ephs.dtype.names]
+                     + [simdat[col] for col in simdat.dtype.names] + [dmags[col] for col in dmags.dtype.names])
+        obsBlock = np.rec.fromarrays(outArrays, names=outCols)
+        self.obsWriter.write(obsBlock)
 
-        if not self.wroteHeader:
-            writestring = ''
-            for col in outCols:
-                writestring += '%s ' %(col)
-            self.outfile.write('%s\n' %(writestring))
-            self.wroteHeader = True
 
-        # Write results.
-        for eph, simdat, dm in zip(ephs, simdata[idxObs], dmags):
-            writestring = '%s ' %(objId)
-            for col in ephs.dtype.names:
-                writestring += '%s ' %(eph[col])
-            for col in simdat.dtype.names:
-                writestring += '%s ' %(simdat[col])
-            for col in dm.dtype.names:
-                writestring += '%s ' %(dm[col])
-            self.outfile.write('%s\n' %(writestring))
-        self.outfile.flush()
+## Function to link the above class methods to generate an output file with moving object observations.
 
+def _rowObjIds(orbits):
+    """
+    Return the objIds of orbits as they appear in its rows (as from iterrows): e.g. as floats if all of the orbit
+    columns are numeric. The observations have always been written with these objIds (such as '1000.0').
+    """
+    return orbits.values[:, orbits.columns.get_loc('objId')]
 
-## Function to link the above class methods to generate an output file with moving object observations.
+def _runMoObsBlocks(moogen, orbits, simdata, outfileName, blockSize=100,
+                    rFov=np.radians(1.75), useCamera=True, pointingIndex=None, obsFormat=None):
+    """
+    Generate and write the observations of each object in 'orbits' to outfileName.
+    Orbits are propagated in blocks of 'blockSize' objects, with a single oorb call per block.
+    """
+    nOrbits = len(orbits)
+    for blockStart in range(0, nOrbits, blockSize):
+        ssoBlock = orbits.iloc[blockStart:blockStart + blockSize]
+        ephs = moogen.generateEphs(ssoBlock)
+        interp = moogen.interpolateEphs(ephs)
+        idxObsBlock = moogen.ssoInFovBlock(interp, simdata, rFov=rFov, useCamera=useCamera,
+                                           pointingIndex=pointingIndex)
+        for i, (objId, idxObs) in enumerate(zip(_rowObjIds(ssoBlock), idxObsBlock)):
+            moogen.writeObs(objId, interp, simdata, idxObs, outfileName=outfileName, ephIdx=i,
+                            obsFormat=obsFormat)
+    moogen._closeOutput()
+
+# Per-process state for the runMoObs worker pool (set by _initMoObsWorker, in each worker process).
+_workerMoObs = None
+_workerSimdata = None
+_workerKwargs = None
+
+def _initMoObsWorker(orbits, ephTimes, simdata, pointingIndex, cameraFootprint, blockSize, rFov, useCamera,
+                     obsFormat):
+    """
+    Set up a MoObs in a worker process: each worker initializes its own oorb (and camera, if needed).
+    """
+    global _workerMoObs, _workerSimdata, _workerKwargs
+    _workerMoObs = MoObs()
+    _workerMoObs.orbits = orbits
+    _workerMoObs.ephTimes = ephTimes
+    _workerMoObs.setupOorb()
+    if useCamera:
+        _workerMoObs._setupCamera()
+        _workerMoObs.cameraFootprint = cameraFootprint
+    _workerSimdata = simdata
+    _workerKwargs = {'blockSize':blockSize, 'rFov':rFov, 'useCamera':useCamera,
+                     'pointingIndex':pointingIndex, 'obsFormat':obsFormat}
+
+def _runMoObsShard(shard):
+    """
+    Generate the observations for one shard (a contiguous range of orbits) in a worker process.
+    Returns the name of the shard output file.
+    """
+    shardStart, shardEnd, shardFile = shard
+    orbits = _workerMoObs.orbits.iloc[shardStart:shardEnd]
+    _runMoObsBlocks(_workerMoObs, orbits, _workerSimdata, shardFile, **_workerKwargs)
+    return shardFile
 
 def runMoObs(orbitfile, outfileName, opsimfile,
             dbcols=None, tstep=2./24., nyears=None,
-            rFov=np.radians(1.75), useCamera=True):
-
+            rFov=np.radians(1.75), useCamera=True, useChipLUT=False, blockSize=100, nProcs=1,
+            obsFormat=None, useOrbitCache=False):
+    """
+    Generate observations of the objects in orbitfile, using the pointings from opsimfile,
+    and write them to outfileName (in order of objId).
+    @ useChipLUT : if True (and useCamera), test the camera footprint with a precomputed chip
+                   lookup table (CameraFootprint) instead of calling findChipName for every visit.
+    @ blockSize : number of objects to propagate in each (single) oorb call.
+                  Memory use scales as blockSize * number of ephemeris times.
+    @ nProcs : number of worker processes. If more than 1, the orbits are split into shards
+               which are processed in a multiprocessing pool, then merged into outfileName.
+    @ obsFormat : output file format ('text' or 'hdf'); default is chosen from the outfileName extension.
+    @ useOrbitCache : if True, read the orbits from (or write) a binary cache of orbitfile (see readOrbitCache).
+    """
     from lsst.sims.maf.db import OpsimDatabase
 
+    if obsFormat is None:
+        obsFormat = guessObsFormat(outfileName)
+
     # Read orbits.
     moogen = MoObs()
-    moogen.readOrbits(orbitfile)
+    moogen.readOrbits(orbitfile, useCache=useOrbitCache)
     print "Read orbit information from %s" %(orbitfile)
+    # Process the objects in objId order, so the output does not depend on how the work is split up.
+    moogen.orbits = moogen.orbits.iloc[np.argsort(moogen.orbits['objId'].values, kind='mergesort')]
 
     # Check rfov/camera choices.
+    cameraFootprint = None
     if useCamera:
         print "Using camera footprint"
+        if useChipLUT:
+            moogen.setupCameraFootprint()
+            cameraFootprint = moogen.cameraFootprint
+            print "Using chip lookup table for the camera footprint"
     else:
         print "Not using camera footprint; using circular fov with %f degrees radius" %(np.degrees(rFov))
 
@@ -482,12 +951,29 @@ def runMoObs(orbitfile, outfileName, opsimfile,
     moogen.setTimes(timestep=tstep, ndays=ndays, timestart=simdata['expMJD'].min())
     print "Will generate ephemerides on grid of %f day timesteps, then extrapolate to opsim times." %(tstep)
 
-    moogen.setupOorb()
-    for i, sso in moogen.orbits.iterrows():
-        ephs = moogen.generateEphs(sso)
-        interpfuncs = moogen.interpolateEphs(ephs)
-        idxObs = moogen.ssoInFov(interpfuncs, simdata, rFov=rFov, useCamera=useCamera)
-        moogen.writeObs(sso['objId'], interpfuncs, simdata, idxObs, outfileName=outfileName)
+    # Index the opsim visits once, so each object is only checked against the visits near its track.
+    pointingIndex = PointingIndex(simdata, moogen.ephTimes[:, 0])
+
+    nOrbits = len(moogen.orbits)
+    if nProcs <= 1 or nOrbits < 2:
+        moogen.setupOorb()
+        _runMoObsBlocks(moogen, moogen.orbits, simdata, outfileName, blockSize=blockSize,
+                        rFov=rFov, useCamera=useCamera, pointingIndex=pointingIndex, obsFormat=obsFormat)
+    else:
+        # Split the orbits into more shards than processes, to keep all workers busy.
+        nShards = min(nOrbits, nProcs * 4)
+        bounds = np.linspace(0, nOrbits, nShards + 1).astype(int)
+        shards = [(bounds[i], bounds[i+1], '%s.shard%04d' %(outfileName, i)) for i in range(nShards)]
+        print "Generating observations in %d shards with %d processes." %(nShards, nProcs)
+        pool = Pool(nProcs, initializer=_initMoObsWorker,
+                    initargs=(moogen.orbits, moogen.ephTimes, simdata, pointingIndex, cameraFootprint,
+                              blockSize, rFov, useCamera, obsFormat))
+        try:
+            shardFiles = pool.map(_runMoObsShard, shards)
+        finally:
+            pool.close()
+            pool.join()
+        mergeObsFiles(shardFiles, outfileName, obsFormat)
     print "Wrote output observations to file %s" %(outfileName)
 
 # Test example:
@@ -0,0 +1,372 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+
+__all__ = ['BaseObsWriter', 'TextObsWriter', 'HdfObsWriter', 'obsWriters',
+           'guessObsFormat', 'getObsWriter', 'readObsFile', 'mergeObsFiles',
+           'obsCacheFile', 'writeObsCache', 'readObsCache']
+
+
+class BaseObsWriter(object):
+    """
+    Base class for the writers of moving object observations.
+    Writers receive the observations of one (or more) objects at a time, as a numpy structured array
+    with one field per output column, and append them to the output file.
+    """
+    def __init__(self, outfileName):
+        self.outfileName = outfileName
+
+    def write(self, obsBlock):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TextObsWriter(BaseObsWriter):
+    """
+    Write observations as whitespace-separated text, with a single header line of column names.
+    Each block of observations is formatted column by column (with numpy), and the formatted text
+    is buffered across blocks, only being written to disk once it exceeds 'bufferSize' bytes.
+    """
+    def __init__(self, outfileName, bufferSize=8*1024*1024):
+        super(TextObsWriter, self).__init__(outfileName)
+        self.outfile = open(outfileName, 'w')
+        self.wroteHeader = False
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.bufferLength = 0
+
+    def _formatBlock(self, obsBlock):
+        """
+        Format all of the observations in obsBlock as text lines, each value followed by a space.
+        (numpy's string conversion gives the same text as '%s' on each value).
+        """
+        lines = None
+        for col in obsBlock.dtype.names:
+            colstrings = np.char.add(obsBlock[col].astype(str), ' ')
+            if lines is None:
+                lines = colstrings
+            else:
+                lines = np.char.add(lines, colstrings)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, obsBlock):
+        if not self.wroteHeader:
+            writestring = ''
+            for col in obsBlock.dtype.names:
+                writestring += '%s ' %(col)
+            self.buffer.append('%s\n' %(writestring))
+            self.wroteHeader = True
+        if len(obsBlock) > 0:
+            text = self._formatBlock(obsBlock)
+            self.buffer.append(text)
+            self.bufferLength += len(text)
+        if self.bufferLength >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered text to disk.
+        """
+        self.outfile.write(''.join(self.buffer))
+        self.outfile.flush()
+        self.buffer = []
+        self.bufferLength = 0
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+
+class HdfObsWriter(BaseObsWriter):
+    """
+    Write observations to a (columnar, compressed) HDF5 table, appending each block of observations.
+    Requires PyTables.
+    """
+    def __init__(self, outfileName, key='obs', complevel=5, strLength=16):
+        super(HdfObsWriter, self).__init__(outfileName)
+        self.key = key
+        self.strLength = strLength
+        self.store = pd.HDFStore(outfileName, mode='w', complevel=complevel, complib='blosc')
+        self.nRows = 0
+
+    def write(self, obsBlock):
+        df = pd.DataFrame.from_records(obsBlock)
+        # Number the rows continuously through the whole table.
+        df.index = np.arange(self.nRows, self.nRows + len(df))
+        self.nRows += len(df)
+        # Leave room for longer strings (e.g. filter names) in later blocks.
+        minItemsize = dict([(col, self.strLength) for col in df.columns if df[col].dtype == object])
+        self.store.append(self.key, df, format='table', index=False, data_columns=['objId'],
+                          min_itemsize=minItemsize)
+
+    def close(self):
+        self.store.close()
+
+
+obsWriters = {'text':TextObsWriter, 'hdf':HdfObsWriter}
+
+
+def guessObsFormat(obsfile):
+    """
+    Return the observation file format ('hdf' or 'text') implied by the filename extension.
+    """
+    if os.path.splitext(obsfile)[1].lower() in ('.h5', '.hdf5', '.hdf'):
+        return 'hdf'
+    return 'text'
+
+
+def getObsWriter(outfileName, obsFormat=None):
+    """
+    Instantiate the writer for obsFormat (if None, guessed from the outfileName extension).
+    """
+    if obsFormat is None:
+        obsFormat = guessObsFormat(outfileName)
+    if obsFormat not in obsWriters:
+        raise ValueError('Observation format %s not one of %s' %(obsFormat, obsWriters.keys()))
+    return obsWriters[obsFormat](outfileName)
+
+
+def _fixObsColumns(obs):
+    """
+    We may have to rename the first column from '#objId' to 'objId'.
+    """
+    if obs.columns.values[0].startswith('#'):
+        newcols = obs.columns.values
+        newcols[0] = newcols[0].replace('#', '')
+        obs.columns = newcols
+    return obs
+
+
+def _iterObsChunks(reader):
+    for obs in reader:
+        yield _fixObsColumns(obs)
+
+
+def readObsFile(obsfile, obsFormat=None, chunkSize=None):
+    """
+    Read the observations written by MoObs into a pandas DataFrame.
+    @ chunkSize : if not None, return an iterator over DataFrames of (at most) chunkSize rows each
+       instead, so that the whole file never has to be held in memory.
+    """
+    if obsFormat is None:
+        obsFormat = guessObsFormat(obsfile)
+    if obsFormat == 'hdf':
+        if chunkSize is not None:
+            return pd.read_hdf(obsfile, 'obs', chunksize=chunkSize)
+        obs = pd.read_hdf(obsfile, 'obs')
+    else:
+        if chunkSize is not None:
+            return _iterObsChunks(pd.read_table(obsfile, delim_whitespace=True, chunksize=chunkSize))
+        obs = _fixObsColumns(pd.read_table(obsfile, delim_whitespace=True))
+    return obs
+
+
+def mergeObsFiles(shardFiles, outfileName, obsFormat=None):
+    """
+    Concatenate the shard observation files, in order, into outfileName (removing the shard files).
+    Shards without any observations did not write a file and are skipped.
+    """
+    if obsFormat is None:
+        obsFormat = guessObsFormat(outfileName)
+    shardFiles = [f for f in shardFiles if os.path.isfile(f)]
+    if len(shardFiles) == 0:
+        return
+    if obsFormat == 'text':
+        # Just copy the text, keeping a single header line.
+        with open(outfileName, 'w') as outfile:
+            for i, shardFile in enumerate(shardFiles):
+                with open(shardFile, 'r') as infile:
+                    header = infile.readline()
+                    if i == 0:
+                        outfile.write(header)
+                    shutil.copyfileobj(infile, outfile)
+    else:
+        writer = getObsWriter(outfileName, obsFormat)
+        for shardFile in shardFiles:
+            writer.write(readObsFile(shardFile, obsFormat).to_records(index=False))
+        writer.close()
+    for shardFile in shardFiles:
+        os.remove(shardFile)
+
+
+def _openTempFile(filename):
+    """
+    Create and open (for writing) a uniquely named temporary file in the directory of filename, with the
+    permissions of a newly created file, to be renamed to filename once written.
+    Returns the open file and the temporary file name.
+    """
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(filename)))
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmpname, 0666 & ~umask)
+    return os.fdopen(fd, 'wb'), tmpname
+
+
+# The resolution of file modification times (1 s on many file systems, 2 s on FAT).
+_mtimeResolution = 2.0
+
+
+def _fileStamp(filename):
+    """
+    Identify the current version of filename, by its path, inode, size, modification and change times.
+    """
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime
+
+
+def _fileHash(filename, blockSize=4*1024*1024):
+    """
+    Return the sha1 hash of the contents of filename.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(blockSize)
+        while block:
+            h.update(block)
+            block = f.read(blockSize)
+    return h.hexdigest()
+
+
+def _cacheInfo(stamp, sourceHash, stampTime):
+    """
+    Return the information identifying the contents of the source file of a cache, to save with the cache:
+    the stamp of the file, the hash of its contents and the time the stamp was taken.
+    """
+    return np.array([repr(stamp), sourceHash, repr(stampTime)])
+
+
+def _readStamped(filename, readFunc, maxTries=3):
+    """
+    Return readFunc(filename), together with the cache information (see _cacheInfo) of the contents which were read.
+    The stamp of filename is taken before reading and checked again after reading, so that a file
+    changed while it is being read is read again.
+    """
+    for i in range(maxTries):
+        stampTime = time.time()
+        stamp = _fileStamp(filename)
+        sourceHash = _fileHash(filename)
+        result = readFunc(filename)
+        if _fileStamp(filename) == stamp:
+            return result, _cacheInfo(stamp, sourceHash, stampTime)
+    raise IOError('%s changed while it was being read.' %(filename))
+
+
+def _checkCacheInfo(filename, info):
+    """
+    Check whether the cache information info (see _cacheInfo) describes the current contents of filename.
+    The contents are only hashed again if the stamp of filename has changed, or if the stamp could not identify
+    the contents (the file was changed within the resolution of the modification times of when it was stamped).
+    Returns (current, newInfo): if the contents are current but the stamp was not, newInfo is the
+    cache information to restamp the cache with (otherwise None).
+    """
+    cachedStamp, cachedHash, cachedTime = [str(x) for x in info]
+    stampTime = time.time()
+    stamp = _fileStamp(filename)
+    if cachedStamp == repr(stamp) and max(stamp[3], stamp[4]) < float(cachedTime) - _mtimeResolution:
+        return True, None
+    sourceHash = _fileHash(filename)
+    if sourceHash != cachedHash or _fileStamp(filename) != stamp:
+        return False, None
+    return True, _cacheInfo(stamp, sourceHash, stampTime)
+
+
+def obsCacheFile(obsfile):
+    """
+    Return the name of the file caching the observations of obsfile.
+    """
+    return obsfile + '.cache.npy'
+
+
+def _writeObsCacheFile(cachefile, records, objId, start, stop, info):
+    """
+    Write the observation records, followed by the objId offset table and the cache information, to cachefile.
+    Everything is kept in a single file (written to a uniquely named temporary file and then renamed), so other
+    processes never see a partial cache, or records and offsets from different versions of the cache.
+    """
+    f, tmpname = _openTempFile(cachefile)
+    with f:
+        for array in (records, objId, start, stop, info):
+            np.save(f, array)
+    os.rename(tmpname, cachefile)
+
+
+def _readObsCacheFile(cachefile):
+    """
+    Return the (memory-mapped) observation records, objIds, start/stop offsets and cache information
+    saved in cachefile.
+    """
+    with open(cachefile, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        nRecords = int(np.prod(shape))
+        # Skip the records, to read the (small) arrays after them.
+        f.seek(offset + nRecords * dtype.itemsize)
+        objId, start, stop, info = [np.load(f) for i in range(4)]
+        if nRecords > 0:
+            records = np.memmap(f, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            records = np.zeros(shape, dtype)
+    return records, objId, start, stop, info
+
+
+def writeObsCache(obsfile, obsFormat=None):
+    """
+    Convert the observations in obsfile to a fixed-dtype binary numpy file (sorted by objId),
+    which can later be memory-mapped, together with a table of the offsets of the observations of each objId
+    and the information (stamp and content hash) identifying the version of obsfile it was made from.
+    """
+    obs, info = _readStamped(obsfile, lambda filename: readObsFile(filename, obsFormat))
+    if 'magFilter' not in obs.columns.values:
+        obs['magFilter'] = obs['magV'] + obs['dmagColor']
+    # Sort by objId (stable, so each object's observations stay in the order they were written).
+    obs = obs.iloc[np.argsort(obs['objId'].values, kind='mergesort')]
+    records = obs.to_records()
+    # Convert any object (string) columns to fixed length strings, so the records can be memory-mapped.
+    dtype = []
+    for name in records.dtype.names:
+        if records[name].dtype == object:
+            maxLength = max([len(str(x)) for x in records[name]] + [1])
+            dtype.append((name, 'S%d' %(maxLength)))
+        else:
+            dtype.append((name, records[name].dtype))
+    records = np.array(records, dtype=dtype)
+    obsIds = records['objId']
+    objId = np.unique(obsIds)
+    start = np.searchsorted(obsIds, objId, side='left')
+    stop = np.searchsorted(obsIds, objId, side='right')
+    _writeObsCacheFile(obsCacheFile(obsfile), records, objId, start, stop, info)
+
+
+def readObsCache(obsfile, obsFormat=None):
+    """
+    Return the (memory-mapped) cached observation records of obsfile, together with the objIds
+    and the start/stop offsets of the records of each objId.
+    The cache is (re)built first if it does not exist or if the contents of obsfile have changed since it was written.
+    """
+    cachefile = obsCacheFile(obsfile)
+    if os.path.isfile(cachefile):
+        try:
+            records, objId, start, stop, info = _readObsCacheFile(cachefile)
+        except (IOError, ValueError):
+            # Not a (complete) cache file of this format: rebuild it.
+            info = None
+        if info is not None:
+            current, newInfo = _checkCacheInfo(obsfile, info)
+            if current:
+                if newInfo is not None:
+                    _writeObsCacheFile(cachefile, records, objId, start, stop, newInfo)
+                return records, objId, start, stop
+    writeObsCache(obsfile, obsFormat)
+    records, objId, start, stop, info = _readObsCacheFile(cachefile)
+    return records, objId, start, stop
@@ -5,6 +5,48 @@ from matplotlib.patches import Ellipse
 from matplotlib.collections import PatchCollection
 
 from lsst.sims.maf.plots import BasePlotter
+from moMetricValues import asMaskedArray
+
+
+def _selectTimeBin(metricValue, plotDict):
+    """
+    Return the metric values in time bin plotDict['timeIdx'] (by default, the last - i.e. the whole survey)
+    if the metric values are time-resolved (nSso, nH, nTimeBins).
+    """
+    if metricValue.ndim < 3:
+        return metricValue
+    timeIdx = plotDict.get('timeIdx')
+    if timeIdx is None:
+        timeIdx = -1
+    return metricValue[:, :, timeIdx]
+
+
+def _binnedReduce(binIdx, values, nBins, reduceFunc, badval):
+    """
+    Apply reduceFunc to the values in each bin (binIdx gives the bin of each value, -1 for none),
+    returning an array of nBins values (badval for empty bins).
+    The mean and sum are calculated with bincount; any other reduceFunc is applied to each occupied bin
+    in turn, after sorting the values by bin.
+    """
+    inBins = binIdx >= 0
+    binIdx = binIdx[inBins]
+    values = np.asarray(values, float)[inBins]
+    binvals = np.zeros(nBins, dtype='float') + badval
+    counts = np.bincount(binIdx, minlength=nBins)
+    occupied = counts > 0
+    if reduceFunc is np.mean or reduceFunc is np.sum:
+        sums = np.bincount(binIdx, weights=values, minlength=nBins)
+        if reduceFunc is np.mean:
+            sums[occupied] = sums[occupied] / counts[occupied]
+        binvals[occupied] = sums[occupied]
+        return binvals
+    order = np.argsort(binIdx, kind='mergesort')
+    values = values[order]
+    stops = np.cumsum(counts)
+    starts = stops - counts
+    for b in np.where(occupied)[0]:
+        binvals[b] = reduceFunc(values[starts[b]:stops[b]])
+    return binvals
 
 
 class MetricVsH(BasePlotter):
@@ -16,14 +58,41 @@ class MetricVsH(BasePlotter):
         self.plotType = 'MetricVsH'
         self.objectPlotter = False
         self.defaultPlotDict = {'title':None, 'xlabel':'H (mag)', 'ylabel':None, 'label':None,
-                                'linestyle':'-', 'npReduce':None, 'nbins':None}
+                                'linestyle':'-', 'npReduce':None, 'nbins':None, 'timeIdx':None}
         self.minHrange=1.0
 
+    def _Hbins(self, Hvals, plotDict):
+        """
+        Return the bins of H, for when each object has its own H value.
+        """
+        hrange = Hvals.max() - Hvals.min()
+        minH = Hvals.min()
+        if hrange < self.minHrange:
+            hrange = self.minHrange
+            minH = Hvals.min() - hrange/2.0
+        nbins = plotDict['nbins']
+        if nbins is None:
+            nbins = 30
+        stepsize = hrange  / float(nbins)
+        return np.arange(minH, minH + hrange + stepsize/2.0, stepsize)
+
+    def binSlicePoints(self, slicer, userPlotDict):
+        """
+        Calculate (and cache on the slicer) the bin indexes of the slicePoints used by this plot.
+        """
+        plotDict = {}
+        plotDict.update(self.defaultPlotDict)
+        plotDict.update(userPlotDict)
+        Hvals = slicer.slicePoints['H']
+        if len(Hvals) != slicer.slicerShape[1]:
+            slicer.binIndex('H', self._Hbins(Hvals, plotDict))
+
     def __call__(self, metricValue, slicer, userPlotDict, fignum=None):
         fig = plt.figure(fignum)
         plotDict = {}
         plotDict.update(self.defaultPlotDict)
         plotDict.update(userPlotDict)
+        metricValue = _selectTimeBin(asMaskedArray(metricValue), plotDict)
         Hvals = slicer.slicePoints['H']
         reduceFunc = plotDict['npReduce']
         if reduceFunc is None:
@@ -38,19 +107,9 @@ class MetricVsH(BasePlotter):
             mVals = reduceFunc(metricValue, axis=0)
         else:
             # Probably each object has its own H value.
-            hrange = Hvals.max() - Hvals.min()
-            minH = Hvals.min()
-            if hrange < self.minHrange:
-                hrange = self.minHrange
-                minH = Hvals.min() - hrange/2.0
-            nbins = plotDict['nbins']
-            if nbins is None:
-                nbins = 30
-            stepsize = hrange  / float(nbins)
-            bins = np.arange(minH, minH + hrange + stepsize/2.0, stepsize)
+            bins = self._Hbins(Hvals, plotDict)
             # In each bin of H, calculate the 'npReduce' value of the corresponding metricValues.
-            inds = np.digitize(Hvals, bins)
-            inds = inds-1
+            inds = slicer.binIndex('H', bins)
             mVals = np.zeros(len(bins), float)
             for i in range(len(bins)):
                 match = metricValue[inds == i]
@@ -84,16 +143,14 @@ class MetricVsOrbit(BasePlotter):
                                 'label':None, 'cmap':cm.cubehelix,
                                 'npReduce':None,
                                 'nxbins':None, 'nybins':None, 'levels':None,
-                                'Hval':None, 'Hwidth':None}
+                                'Hval':None, 'Hwidth':None, 'timeIdx':None}
 
-    def __call__(self, metricValue, slicer, userPlotDict, fignum=None):
-        fig = plt.figure(fignum)
-        plotDict = {}
-        plotDict.update(self.defaultPlotDict)
-        plotDict.update(userPlotDict)
+    def _orbitBins(self, slicer, plotDict):
+        """
+        Return the x and y bins of the orbital parameters.
+        """
         xvals = slicer.slicePoints['orbits'][plotDict['xaxis']]
         yvals = slicer.slicePoints['orbits'][plotDict['yaxis']]
-        # Set x/y bins.
         nxbins = plotDict['nxbins']
         nybins = plotDict['nybins']
         if nxbins is None:
@@ -110,6 +167,26 @@ class MetricVsOrbit(BasePlotter):
         else:
             ybinsize = (yvals.max() - yvals.min())/float(nybins)
             ybins = np.arange(yvals.min(), yvals.max() + ybinsize/2.0, ybinsize)
+        return xbins, ybins
+
+    def binSlicePoints(self, slicer, userPlotDict):
+        """
+        Calculate (and cache on the slicer) the bin indexes of the slicePoints used by this plot.
+        """
+        plotDict = {}
+        plotDict.update(self.defaultPlotDict)
+        plotDict.update(userPlotDict)
+        xbins, ybins = self._orbitBins(slicer, plotDict)
+        slicer.binIndex(plotDict['xaxis'], xbins)
+        slicer.binIndex(plotDict['yaxis'], ybins)
+
+    def __call__(self, metricValue, slicer, userPlotDict, fignum=None):
+        fig = plt.figure(fignum)
+        plotDict = {}
+        plotDict.update(self.defaultPlotDict)
+        plotDict.update(userPlotDict)
+        metricValue = _selectTimeBin(asMaskedArray(metricValue), plotDict)
+        xbins, ybins = self._orbitBins(slicer, plotDict)
         nxbins = len(xbins)
         nybins = len(ybins)
         # Identify the relevant metricValues for the Hvalue we want to plot.
@@ -129,19 +206,15 @@ class MetricVsOrbit(BasePlotter):
         else:
             mVals = metricValue[Hidx].filled()
         # Calculate the npReduce'd metric values at each x/y bin.
-        binvals = np.zeros((nybins, nxbins), dtype='float') + slicer.badval
-        xidxs = np.digitize(xvals, xbins) - 1
-        yidxs = np.digitize(yvals, ybins) - 1
+        xidxs = slicer.binIndex(plotDict['xaxis'], xbins)
+        yidxs = slicer.binIndex(plotDict['yaxis'], ybins)
         reduceFunc = plotDict['npReduce']
         if reduceFunc is None:
             reduceFunc = np.mean
-        for iy in range(nybins):
-            ymatch = np.where(yidxs == iy)[0]
-            for ix in range(nxbins):
-                xmatch = np.where(xidxs[ymatch] == ix)[0]
-                matchVals = mVals[ymatch][xmatch]
-                if len(matchVals) > 0:
-                    binvals[iy][ix] = reduceFunc(matchVals)
+        inBins = (xidxs >= 0) & (xidxs < nxbins) & (yidxs >= 0) & (yidxs < nybins)
+        binIdx = np.where(inBins, yidxs * nxbins + xidxs, -1)
+        binvals = _binnedReduce(binIdx, mVals, nybins * nxbins, reduceFunc, slicer.badval)
+        binvals = binvals.reshape(nybins, nxbins)
         xi, yi = np.meshgrid(xbins, ybins)
         if 'colorMin' in plotDict:
             vMin = plotDict['colorMin']
@@ -175,13 +248,15 @@ class MetricVsOrbitPoints(BasePlotter):
                                 'label':None, 'cmap':cm.cubehelix,
                                 'xaxis':xaxis, 'yaxis':yaxis,
                                 'Hval':None, 'Hwidth':None,
-                                'foregroundPoints':True, 'backgroundPoints':False}
+                                'foregroundPoints':True, 'backgroundPoints':False,
+                                'timeIdx':None}
 
     def __call__(self, metricValue, slicer, userPlotDict, fignum=None):
         fig = plt.figure(fignum)
         plotDict = {}
         plotDict.update(self.defaultPlotDict)
         plotDict.update(userPlotDict)
+        metricValue = _selectTimeBin(asMaskedArray(metricValue), plotDict)
         xvals = slicer.slicePoints['orbits'][plotDict['xaxis']]
         yvals = slicer.slicePoints['orbits'][plotDict['yaxis']]
         # Identify the relevant metricValues for the Hvalue we want to plot.
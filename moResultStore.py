@@ -0,0 +1,139 @@
+import os
+import inspect
+import hashlib
+import cPickle
+import numpy as np
+from moObsIO import _openTempFile
+
+__all__ = ['MoResultStore']
+
+
+class MoResultStore(object):
+    """
+    Save the metric values calculated at each slicepoint, so that they only need to be recalculated
+    when the observations of the object (or the metric configuration) change.
+
+    Each result is the array of metric values of one metric at one slicepoint (for all of its Hvals),
+    keyed by a hash of the metric configuration (its class, code version and constructor parameters) and a hash of
+    the contents of the slicepoint - the observations of the object (after any constraint is applied), its orbit,
+    the Hvals and the seed for the random visibility calculation.
+    Results are never replaced, so the results of old versions of the observations accumulate:
+    prune() (or save(prune=True)) removes the results which were not used since the store was read.
+    """
+    def __init__(self, filename=None):
+        """
+        @ filename : the file to save the results in (and read previous results from, if it exists).
+          If None, results are only kept in memory.
+        """
+        self.filename = filename
+        self.results = {}
+        # The keys of the results used (or calculated) since the store was read.
+        self.used = set()
+        if self.filename is not None and os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                self.results = cPickle.load(f)
+
+    def _config(self, value):
+        """
+        Convert a (metric) attribute to a simple (repr-able) value, or None if it is a method.
+        """
+        if callable(value):
+            return None
+        if isinstance(value, dict):
+            return sorted([(k, self._config(v)) for k, v in value.iteritems() if not callable(v)])
+        if isinstance(value, (list, tuple)):
+            return [self._config(v) for v in value]
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        return value
+
+    # Constructor parameters which only affect how the metric values are labelled, not the values themselves.
+    displayParameters = ('metricName', 'units')
+
+    def metricKey(self, metric):
+        """
+        Return the key of the metric configuration: its class, the version of its code (the source of the metric
+        class and its base classes, and its metricVersion) and the values of its constructor parameters
+        (of the metric class and its base classes), which metrics must save as attributes of the same name.
+        Other attributes (such as name/units, which the reduce methods change) do not affect the key.
+        """
+        h = hashlib.sha1()
+        h.update('%s.%s' %(metric.__class__.__module__, metric.__class__.__name__))
+        h.update(repr(getattr(metric, 'metricVersion', None)))
+        params = set()
+        for cls in type(metric).__mro__:
+            if cls is object:
+                continue
+            try:
+                h.update(inspect.getsource(cls))
+            except (IOError, TypeError):
+                # No source available (e.g. a class defined interactively): rely on its metricVersion.
+                pass
+            if '__init__' in cls.__dict__ and inspect.ismethod(cls.__init__):
+                params.update(inspect.getargspec(cls.__init__).args[1:])
+        params = sorted(params.difference(self.displayParameters))
+        missing = [k for k in params if not hasattr(metric, k)]
+        if len(missing) > 0:
+            raise ValueError('Cannot key the results of %s: its constructor parameters %s are not saved as attributes '
+                             'of the same name.' %(metric.__class__.__name__, ', '.join(missing)))
+        h.update(repr([(k, self._config(getattr(metric, k))) for k in params]))
+        return h.hexdigest()
+
+    def slicePointKey(self, slicePoint, seed=None):
+        """
+        Return the key of the contents of a slicepoint.
+        """
+        h = hashlib.sha1()
+        obs = slicePoint['obs']
+        for name in obs.dtype.names:
+            # The index is the row of the observation in the observation file, which changes if objects are added.
+            if name == 'index':
+                continue
+            h.update(name)
+            col = obs[name]
+            if col.dtype == object:
+                h.update(repr(col.tolist()))
+            else:
+                h.update(np.ascontiguousarray(col).tostring())
+        orb = slicePoint['orbit']
+        h.update(repr(zip(orb.index.tolist(), orb.values.tolist())))
+        h.update(np.asarray(slicePoint['Hvals'], float).tostring())
+        h.update(repr(seed))
+        return h.hexdigest()
+
+    def get(self, metricKey, slicePointKey):
+        """
+        Return the saved metric values, or None if there are none.
+        """
+        return self.results.get((metricKey, slicePointKey))
+
+    def put(self, metricKey, slicePointKey, metricValues):
+        self.results[(metricKey, slicePointKey)] = np.array(metricValues)
+        self.used.add((metricKey, slicePointKey))
+
+    def markUsed(self, metricKey, slicePointKey):
+        """
+        Record that the saved result was used, so that prune keeps it.
+        """
+        self.used.add((metricKey, slicePointKey))
+
+    def prune(self):
+        """
+        Remove the results which were not used (or calculated) since the store was read.
+        """
+        self.results = dict([(key, value) for key, value in self.results.iteritems() if key in self.used])
+
+    def save(self, prune=False):
+        """
+        Write the results to filename.
+        @ prune : if True, prune the results first (only keeping the results used since the store was read).
+        """
+        if prune:
+            self.prune()
+        if self.filename is None:
+            return
+        # Write to a (uniquely named) temporary file and then rename, so a partial file is never seen.
+        f, tmpname = _openTempFile(self.filename)
+        with f:
+            cPickle.dump(self.results, f, 2)
+        os.rename(tmpname, self.filename)
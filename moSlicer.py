@@ -1,19 +1,23 @@
 import os
+from copy import copy
 import numpy as np
 import pandas as pd
 
 from moObs import MoOrbits
+from moObsIO import readObsFile, readObsCache
+from moMetricValues import asMaskedArray
 from moPlots import *
 
 __all__ = ['MoSlicer']
 
 class MoSlicer(MoOrbits):
 
-    def __init__(self, orbitfile, Hrange=None):
+    def __init__(self, orbitfile, Hrange=None, useOrbitCache=False):
         """
         Instantiate the MoSlicer object.
 
         orbitfile = the file with the orbit information on the objects.
+        useOrbitCache = if True, read the orbits from (or write) a binary cache of orbitfile (see moObs.readOrbitCache).
 
         Iteration over the MoSlicer will go as:
           - iterate over each orbit;
@@ -21,9 +25,12 @@ class MoSlicer(MoOrbits):
         """
         self.slicerName = 'MoSlicer'
         # Read orbits (inherited from MoOrbits).
-        self.readOrbits(orbitfile)
+        self.readOrbits(orbitfile, useCache=useOrbitCache)
         self.slicePoints = {}
         self.slicePoints['orbits'] = self.orbits
+        # Observations are read (or streamed) later, by readObs.
+        self.chunkSize = None
+        self.setConstraints(None)
         # See if we're cloning orbits.
         self.Hrange = Hrange
         # And set the slicer shape/size.
@@ -35,61 +42,235 @@ class MoSlicer(MoOrbits):
             self.slicePoints['H'] = self.orbits['H']
         # Set the rest of the slicePoint information once
         self.badval = 0
+        # Bin indexes of the slicePoint values, shared between the plotters (see binIndex).
+        self._binCache = {}
+        self._binCacheState = None
         # Set default plotFuncs.
         self.plotFuncs = [MetricVsH(),
                           MetricVsOrbit(xaxis='q', yaxis='e'),
                           MetricVsOrbit(xaxis='q', yaxis='inc')]
 
 
-    def readObs(self, obsfile):
+    def readObs(self, obsfile, obsFormat=None, chunkSize=None, useCache=False):
         """
         Read observations created by moObs.
+        @ obsFormat : the observation file format ('text' or 'hdf'); default is chosen from the file extension.
+        @ chunkSize : if not None, do not read the whole file now - instead stream it in chunks of chunkSize
+           rows while iterating over the slicer, so memory is bounded by the chunk size and the observations of
+           a single object. The observation file must then be sorted by objId (as written by moObs), the orbits
+           are iterated in objId order, and the observations can only be accessed by iterating over the slicer.
+        @ useCache : if True, memory-map a binary cache of the observations (written next to obsfile the first
+           time, and rewritten whenever obsfile changes) instead of parsing obsfile. Processes reading the same
+           obsfile then share the cached observations through the page cache.
         """
-        # For now, just read all the observations (should be able to chunk this though).
         self.obsfile = obsfile
-        self.allObs = pd.read_table(obsfile, delim_whitespace=True)
-        # We may have to rename the first column from '#objId' to 'objId'.
-        if self.allObs.columns.values[0].startswith('#'):
-            newcols = self.allObs.columns.values
-            newcols[0] = newcols[0].replace('#', '')
-            self.allObs.columns = newcols
-        if 'magFilter' not in self.allObs.columns.values:
-            self.allObs['magFilter'] = self.allObs['magV'] + self.allObs['dmagColor']
+        self.obsFormat = obsFormat
+        self.chunkSize = chunkSize
+        if self.chunkSize is not None:
+            # Put the orbits in the same (objId) order as the observations in the file.
+            order = np.argsort(self.orbits['objId'].values, kind='mergesort')
+            self.orbits = self.orbits.iloc[order]
+            self.slicePoints['orbits'] = self.orbits
+            if self.Hrange is None:
+                self.slicePoints['H'] = self.orbits['H']
+            self.allObs = None
+            self.subsetObs()
+            return
+        if useCache:
+            self.allObs = None
+            records, self.cacheIds, self.cacheStart, self.cacheStop = readObsCache(obsfile, obsFormat)
+            self.allRecords = records.view(np.recarray)
+            self.subsetObs()
+            return
+        allObs = readObsFile(obsfile, obsFormat)
+        if 'magFilter' not in allObs.columns.values:
+            allObs['magFilter'] = allObs['magV'] + allObs['dmagColor']
+        # Sort by objId (stable, so each object's observations stay in the order they were written),
+        # so that the observations of each object are contiguous.
+        self.allObs = allObs.iloc[np.argsort(allObs['objId'].values, kind='mergesort')]
         self.subsetObs()
 
     def subsetObs(self, pandasConstraint=None):
         """
         Choose a subset of all the observations, such as those in a particular time period.
+        (When streaming, the constraint is applied to each chunk as it is read).
         """
-        if pandasConstraint is None:
-            self.obs = self.allObs
+        self.pandasConstraint = pandasConstraint
+        if self.chunkSize is not None:
+            self.obs = None
+            return
+        if self.allObs is None:
+            # Observations are memory-mapped from the cache.
+            self.obs = None
+            if pandasConstraint is None:
+                self.obsRecords = self.allRecords
+                # Use the cached offset table, rather than searching through all the observations.
+                orbitIds = self.orbits['objId'].values
+                pos = np.searchsorted(self.cacheIds, orbitIds)
+                found = pos < len(self.cacheIds)
+                found[found] = self.cacheIds[pos[found]] == orbitIds[found]
+                pos[~found] = 0
+                self.obsStart = np.where(found, self.cacheStart[pos], 0)
+                self.obsStop = np.where(found, self.cacheStop[pos], 0)
+            else:
+                self.obsRecords = self.allRecords[self._evalConstraint(self.allRecords, pandasConstraint)]
+                self._indexObs()
         else:
-            self.obs = self.allObs.query(pandasConstraint)
+            if pandasConstraint is None:
+                self.obs = self.allObs
+            else:
+                self.obs = self.allObs.query(pandasConstraint)
+            self.obsRecords = self.obs.to_records()
+            self._indexObs()
+        # Re-evaluate any constraint masks on the new observations.
+        self.setConstraints(self.constraints)
+
+    def _evalConstraint(self, records, pandasConstraint):
+        """
+        Return a boolean array, True where the observations in the record array match pandasConstraint.
+        """
+        cols = dict([(name, records[name]) for name in records.dtype.names])
+        match = np.zeros(len(records), bool)
+        match |= np.asarray(pd.eval(pandasConstraint, resolvers=[cols]), bool)
+        return match
+
+    def setConstraints(self, constraints):
+        """
+        Set (or clear, with None) a list of pandas constraints to evaluate as boolean masks on the current
+        observations. Each slicePoint then also includes 'constraintMasks': a dictionary of the mask of its
+        observations for each constraint (other than None), so that the observations matching each constraint can be
+        selected without slicing the observations again for each constraint.
+        """
+        self.constraints = []
+        if constraints is not None:
+            self.constraints = [c for c in constraints if c is not None]
+        self.constraintMasks = {}
+        if self.chunkSize is None and len(self.constraints) > 0:
+            # Evaluate each constraint once, over all of the observations.
+            for c in self.constraints:
+                self.constraintMasks[c] = self._evalConstraint(self.obsRecords, c)
+
+    def _indexObs(self):
+        """
+        Find the start/stop offsets of the observations of each orbit in the (objId-sorted) record array
+        of the current observations, so each can be sliced directly.
+        """
+        obsIds = self.obsRecords['objId']
+        orbitIds = self.orbits['objId'].values
+        self.obsStart = np.searchsorted(obsIds, orbitIds, side='left')
+        self.obsStop = np.searchsorted(obsIds, orbitIds, side='right')
 
     def _sliceObs(self, idx):
         """
         Return the observations of ssoId.
-        For now this works for any ssoId; in the future, this might only work as ssoId is
-         progressively iterated through the series of ssoIds (so we can 'chunk' the reading).
+        The observations are a view into the (objId-sorted) record array of the current observations.
         """
         # Find the matching orbit.
         orb = self.orbits.iloc[idx]
         # Find the matching observations.
-        obs = self.obs.query('objId == %d' %(orb['objId']))
+        start = self.obsStart[idx]
+        stop = self.obsStop[idx]
+        obs = self.obsRecords[start:stop]
         # Return the values for H to consider for metric.
         if self.Hrange is not None:
             Hvals = self.Hrange
         else:
             Hvals = np.array([orb['H']], float)
-        return {'obs': obs.to_records(),
-                'orbit': orb,
-                'Hvals': Hvals}
+        slicePoint = {'obs': obs,
+                      'orbit': orb,
+                      'Hvals': Hvals}
+        if len(self.constraints) > 0:
+            slicePoint['constraintMasks'] = dict([(c, self.constraintMasks[c][start:stop]) for c in self.constraints])
+        return slicePoint
+
+    def _streamObs(self):
+        """
+        Read the observation file chunk by chunk, yielding (objId, observations) for each object in turn.
+        The observations of an object which are split across chunks are joined before being yielded.
+        """
+        pending = None
+        lastId = None
+        for chunk in readObsFile(self.obsfile, self.obsFormat, chunkSize=self.chunkSize):
+            if 'magFilter' not in chunk.columns.values:
+                chunk['magFilter'] = chunk['magV'] + chunk['dmagColor']
+            if self.pandasConstraint is not None:
+                chunk = chunk.query(self.pandasConstraint)
+            if len(chunk) == 0:
+                continue
+            records = chunk.to_records()
+            if self._emptyObs is None:
+                # pandas infers the dtypes of each chunk separately, so fix them from the first chunk - widening
+                # integer columns (other than objId) to float, in case later chunks have non-integer values -
+                # so that the observations of an object split across chunks can be joined.
+                dtype = [(name, float if records.dtype[name].kind in 'iu' and name not in ('objId', 'index')
+                          else records.dtype[name]) for name in records.dtype.names]
+                self._emptyObs = np.recarray(0, dtype=dtype)
+            records = records.astype(self._emptyObs.dtype).view(np.recarray)
+            obsIds = records['objId']
+            if np.any(np.diff(obsIds) < 0) or (lastId is not None and obsIds[0] < lastId):
+                raise ValueError('Observation file %s must be sorted by objId to be streamed.' %(self.obsfile))
+            lastId = obsIds[-1]
+            # Split the chunk into the observations of each object.
+            splits = np.flatnonzero(obsIds[1:] != obsIds[:-1]) + 1
+            groups = np.split(records, splits)
+            if pending is not None:
+                if pending['objId'][0] == obsIds[0]:
+                    groups[0] = np.concatenate([pending, groups[0]]).view(np.recarray)
+                else:
+                    yield pending['objId'][0], pending
+            # The last object in the chunk may continue into the next chunk.
+            for group in groups[:-1]:
+                yield group['objId'][0], group
+            pending = groups[-1]
+        if pending is not None:
+            yield pending['objId'][0], pending
+
+    def _nextStreamGroup(self):
+        try:
+            self._streamGroup = next(self._obsStream)
+        except StopIteration:
+            self._streamGroup = None
+
+    def _streamSliceObs(self, idx):
+        """
+        Return the observations of ssoId idx, advancing through the observation file.
+        """
+        orb = self.orbits.iloc[idx]
+        objId = orb['objId']
+        # Skip over observations of objects not in the orbit file.
+        while self._streamGroup is not None and self._streamGroup[0] < objId:
+            self._nextStreamGroup()
+        if self._streamGroup is not None and self._streamGroup[0] == objId:
+            obs = self._streamGroup[1]
+            self._nextStreamGroup()
+        elif self._emptyObs is not None:
+            obs = self._emptyObs
+        else:
+            obs = np.recarray(0, dtype=[('objId', float)])
+        if self.Hrange is not None:
+            Hvals = self.Hrange
+        else:
+            Hvals = np.array([orb['H']], float)
+        slicePoint = {'obs': obs,
+                      'orbit': orb,
+                      'Hvals': Hvals}
+        if len(self.constraints) > 0:
+            if len(obs) == 0:
+                slicePoint['constraintMasks'] = dict([(c, np.zeros(0, bool)) for c in self.constraints])
+            else:
+                slicePoint['constraintMasks'] = dict([(c, self._evalConstraint(obs, c)) for c in self.constraints])
+        return slicePoint
 
     def __iter__(self):
         """
         Iterate through each of the ssoIds.
         """
         self.idx = 0
+        if self.chunkSize is not None:
+            # Start streaming from the beginning of the observation file.
+            self._emptyObs = None
+            self._obsStream = self._streamObs()
+            self._nextStreamGroup()
         return self
 
     def next(self):
@@ -100,10 +281,87 @@ class MoSlicer(MoOrbits):
             raise StopIteration
         idx = self.idx
         self.idx += 1
+        if self.chunkSize is not None:
+            return self._streamSliceObs(idx)
         return self._sliceObs(idx)
 
+    def iterBatches(self, batchSize):
+        """
+        Iterate through the ssoIds in batches of (up to) batchSize objects, returning (index of first object, batch).
+        """
+        slicePoints = []
+        start = 0
+        for i, slicePoint in enumerate(self):
+            slicePoints.append(slicePoint)
+            if len(slicePoints) == batchSize:
+                yield start, self.makeBatch(slicePoints)
+                slicePoints = []
+                start = i + 1
+        if len(slicePoints) > 0:
+            yield start, self.makeBatch(slicePoints)
+
+    def makeBatch(self, slicePoints):
+        """
+        Combine a list of slicePoints into a batch, for metrics which evaluate many objects at once.
+        The batch is a dictionary of
+          'obs' : the observations of all of the objects, concatenated,
+          'offsets' : the observations of object i are obs[offsets[i]:offsets[i+1]],
+          'objIdx' : the index of the object of each observation,
+          'orbits' : the orbit of each object,
+          'Hvals' : the (nObj, nH) H values of each object, and 'Href' : the H value of each orbit.
+        """
+        nObs = np.array([len(slicePoint['obs']) for slicePoint in slicePoints], int)
+        offsets = np.concatenate([[0], np.cumsum(nObs)])
+        obs = np.concatenate([slicePoint['obs'] for slicePoint in slicePoints]).view(np.recarray)
+        orbits = [slicePoint['orbit'] for slicePoint in slicePoints]
+        return {'obs': obs,
+                'offsets': offsets,
+                'objIdx': np.repeat(np.arange(len(slicePoints)), nObs),
+                'orbits': orbits,
+                'Hvals': np.array([slicePoint['Hvals'] for slicePoint in slicePoints], float),
+                'Href': np.array([orb['H'] for orb in orbits], float)}
+
+    def withHrange(self, Hrange):
+        """
+        Return a copy of the slicer with slicePoints['H'] = Hrange (as if instantiated with Hrange), sharing the
+        orbits and observations of this slicer rather than reading the orbit file again.
+        """
+        slicer = copy(self)
+        slicer.Hrange = Hrange
+        slicer.slicerShape = [self.nSso, len(Hrange)]
+        slicer.slicePoints = {'orbits':self.orbits, 'H':Hrange}
+        slicer._binCache = {}
+        slicer._binCacheState = None
+        return slicer
+
+    def binIndex(self, col, bins):
+        """
+        Return the bin index (np.digitize(values, bins) - 1) of each slicePoint value of col - 'H', or a column
+        of the orbits. The bin indexes are cached (keyed by col and bins), so that plots of all of the bundles
+        using this slicer only bin the slicePoints once; the cache is cleared when the slicePoints
+        (or their orbits or H values) are replaced. The returned index array is read-only.
+        """
+        # Keep references to the binned objects (rather than their ids, which can be reused once freed).
+        state = (self.slicePoints, self.slicePoints['orbits'], self.slicePoints['H'])
+        if (self._binCacheState is None or
+                any(current is not cached for current, cached in zip(state, self._binCacheState))):
+            self._binCache = {}
+            self._binCacheState = state
+        bins = np.asarray(bins, float)
+        key = (col, bins.tostring())
+        if key not in self._binCache:
+            if col == 'H':
+                values = self.slicePoints['H']
+            else:
+                values = self.slicePoints['orbits'][col]
+            inds = np.digitize(np.asarray(values, float), bins) - 1
+            inds.flags.writeable = False
+            self._binCache[key] = inds
+        return self._binCache[key]
+
     def __getitem__(self, idx):
-        # This may not be guaranteed to work if/when we implement chunking of the obsfile.
+        if self.chunkSize is not None:
+            raise ValueError('Observations can only be accessed by iterating over the slicer when streaming.')
         return self._sliceObs(idx)
 
     def __eq__(self, otherSlicer):
@@ -129,7 +387,19 @@ class MoSlicer(MoOrbits):
     def write(self, filename, metricBundle):
         """
         Cheap and dirty write to disk.
+        Metric values calculated in time bins (nSso, nH, nTimeBins) are written with the time axis flattened,
+        one column per (H, time bin) pair.
         """
         #store = pd.HDFStore(filename+'.h5')
-        df = pd.DataFrame(metricBundle.metricValues)
+        metricValues = asMaskedArray(metricBundle.metricValues)
+        columns = None
+        if metricValues.ndim == 3:
+            nSso, nH, nT = metricValues.shape
+            timeBins = metricBundle.metric.timeBins
+            if timeBins is None:
+                timeBins = np.arange(nT)
+            Hvals = self.Hrange if self.Hrange is not None else ['H'] * nH
+            columns = ['%s_%s' %(h, t) for h in Hvals for t in timeBins]
+            metricValues = metricValues.reshape(nSso, nH * nT)
+        df = pd.DataFrame(metricValues, columns=columns)
         df.to_csv(filename)
@@ -0,0 +1,103 @@
+import zlib
+import numpy as np
+
+__all__ = ['MoVisibilityStacker']
+
+
+class MoVisibilityStacker(object):
+    """
+    Calculate the apparent magnitudes, magnitude limits, SNR and visibility of an object
+    once per slicepoint, and share them between all of the metrics run at that slicepoint.
+
+    The stacker is reset with the observations/orbit/Hvals of each slicepoint, and metrics then
+    fetch the values they need with prepH(metric). Values are saved keyed by the columns the metric
+    uses (magFilterCol/m5Col/lossCol), plus its snrLimit for the SNR/visibility - so metrics with the same
+    visibility requirements (including those using the random completeness calculation) see the same values.
+    The stacker can instead be reset with a whole batch of slicepoints (resetBatch), for metrics which
+    calculate a batch at once (prepBatch).
+    """
+    def __init__(self, seed=None):
+        """
+        @ seed : if not None, the random visibility (completeness) calculation draws from a random number
+          generator seeded by (seed, objId, H index, visibility key) - so each slicepoint gets the same
+          draws however (and in whatever order) the slicepoints are evaluated.
+          If None, the global numpy random number generator is used.
+        """
+        self.seed = seed
+        self.reset(None, None, None)
+
+    def reset(self, ssoObs, orb, Hvals):
+        """
+        Set the observations, orbit and Hvals of the current slicepoint (and clear the saved values).
+        """
+        self.ssoObs = ssoObs
+        self.orb = orb
+        self.Hvals = Hvals
+        self.batch = None
+        self.mags = {}
+        self.visibility = {}
+
+    def resetBatch(self, batch):
+        """
+        Set the current batch of slicepoints (see MoSlicer.iterBatches) (and clear the saved values).
+        """
+        self.reset(None, None, None)
+        self.batch = batch
+
+    def _probability(self, orb, visKey, nObs, nH):
+        """
+        Return the (nObs, nH) random numbers for the visibility of the object with orbit orb, drawn from
+        one numpy RandomState per H value, or None if no seed was set.
+        """
+        if self.seed is None:
+            return None
+        objSeed = zlib.crc32(str(orb['objId'])) & 0xffffffff
+        keySeed = zlib.crc32(str(visKey)) & 0xffffffff
+        probability = np.zeros((nObs, nH), float)
+        for hIdx in range(nH):
+            randomState = np.random.RandomState([self.seed, objSeed, hIdx, keySeed])
+            probability[:, hIdx] = randomState.random_sample(nObs)
+        return probability
+
+    def _prep(self, metric, calcAppMag, calcMagLimit, calcProbability):
+        magKey = (metric.magFilterCol, metric.m5Col, metric.lossCol)
+        if magKey not in self.mags:
+            self.mags[magKey] = (calcAppMag(), calcMagLimit()[:, np.newaxis])
+        appMag, magLimit = self.mags[magKey]
+        visKey = magKey + (metric.snrLimit,)
+        if visKey not in self.visibility:
+            probability = None
+            if metric.snrLimit is None:
+                probability = calcProbability(visKey, appMag.shape)
+            self.visibility[visKey] = metric._calcVisibilityH(appMag, magLimit, probability=probability)
+        vis, snr = self.visibility[visKey]
+        return appMag, magLimit, vis, snr
+
+    def prepH(self, metric):
+        """
+        Return appMag, magLimit, vis and snr (as from metric._prepH) for the current slicepoint.
+        """
+        return self._prep(metric,
+                          lambda: metric._calcAppMagH(self.ssoObs, self.orb, self.Hvals),
+                          lambda: metric._calcMagLimit(self.ssoObs),
+                          lambda visKey, shape: self._probability(self.orb, visKey, shape[0], shape[1]))
+
+    def _batchProbability(self, visKey, shape):
+        if self.seed is None:
+            return None
+        # Draw the random numbers object by object, exactly as for a single slicepoint.
+        offsets = self.batch['offsets']
+        probability = np.zeros(shape, float)
+        for i, orb in enumerate(self.batch['orbits']):
+            nObs = offsets[i+1] - offsets[i]
+            probability[offsets[i]:offsets[i+1]] = self._probability(orb, visKey, nObs, shape[1])
+        return probability
+
+    def prepBatch(self, metric):
+        """
+        Return appMag, magLimit, vis and snr (as from metric._prepBatch) for the current batch.
+        """
+        return self._prep(metric,
+                          lambda: metric._calcAppMagBatch(self.batch),
+                          lambda: metric._calcMagLimit(self.batch['obs']),
+                          self._batchProbability)
@@ -3,6 +3,7 @@ import numpy.ma as ma
 import warnings
 
 from moMetrics import BaseMoMetric
+from moMetricValues import asMaskedArray
 
 __all__ = ['ValueAtHMetric']
 
@@ -20,6 +21,7 @@ class ValueAtHMetric(BaseMoMetric):
         if (self.Hmark < Hvals.min()) or (self.Hmark > Hvals.max()):
             warnings.warn('Desired H value of metric outside range of provided H values.')
             return None
+        metricVals = asMaskedArray(metricVals)
         nHvals = len(Hvals)
         nHMetricVals = metricVals.shape[1]
         if nHvals == nHMetricVals:
@@ -28,8 +28,8 @@ def calcCompleteness(orbitfile, obsfile, outDir):
     Saves the plots to disk.
     """
     # Read data back from disk.
-    mos = MoSlicer(orbitfile, Hrange=np.arange(13, 26, 0.5))
-    mos.readObs(obsfile)
+    mos = MoSlicer(orbitfile, Hrange=np.arange(13, 26, 0.5), useOrbitCache=True)
+    mos.readObs(obsfile, useCache=True)
 
     # Nobs
     metric = MoMetrics.NObsMetric()
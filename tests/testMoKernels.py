@@ -0,0 +1,111 @@
+import unittest
+import numpy as np
+import pandas as pd
+import moKernels
+import moMetrics
+from moSlicer import MoSlicer
+
+
+class TestMoKernels(unittest.TestCase):
+    """
+    Check that the numba (loop) and numpy versions of the kernels agree with each other and with the
+    per-object (runH) metric calculations. (Without numba, the loop versions run as plain python.)
+    """
+
+    def setUp(self):
+        self.useNumba = moKernels.useNumba
+        self.rng = np.random.RandomState(7)
+
+    def tearDown(self):
+        moKernels.useNumba = self.useNumba
+
+    def _slicePoints(self, nObj=40, nH=3):
+        """Random slicePoints, including objects without observations."""
+        slicePoints = []
+        Hvals = np.linspace(16, 22, nH)
+        for i in range(nObj):
+            nObs = self.rng.choice([0, 1, 2, 5, 30, 120])
+            night = np.sort(self.rng.randint(0, 400, nObs))
+            obs = np.zeros(nObs, dtype=[('night', float), ('expMJD', float), ('magFilter', float),
+                                        ('fiveSigmaDepth', float), ('dmagDetect', float)])
+            obs['night'] = night
+            # Several observations on the same night, within (or not) the tracklet time.
+            obs['expMJD'] = 49353.0 + night + self.rng.choice([0.0, 0.01, 0.02, 0.05, 0.3], nObs)
+            obs['magFilter'] = self.rng.uniform(20, 24, nObs)
+            obs['fiveSigmaDepth'] = self.rng.uniform(22.5, 24.5, nObs)
+            obs['dmagDetect'] = self.rng.uniform(0, 0.3, nObs)
+            orbit = pd.Series({'objId': i, 'H': 19.0, 'a': self.rng.uniform(1, 3), 'tPeri': 49000.0})
+            slicePoints.append({'obs': obs.view(np.recarray), 'orbit': orbit, 'Hvals': Hvals})
+        return slicePoints
+
+    def _metrics(self):
+        return [moMetrics.NObsMetric(snrLimit=5),
+                moMetrics.NObsMetric(snrLimit=5, timeBins=[30, 200, 365]),
+                moMetrics.DiscoveryChancesMetric(snrLimit=5, nObsPerNight=2, tNight=1.0, nNightsPerWindow=2,
+                                                 tWindow=30),
+                moMetrics.DiscoveryChancesMetric(snrLimit=5, nObsPerNight=2, tNight=1.0, nNightsPerWindow=2,
+                                                 tWindow=30, timeBins=[30, 200, 365]),
+                moMetrics.DiscoveryChancesMetric(snrLimit=5, nObsPerNight=1, nNightsPerWindow=3, tWindow=15),
+                moMetrics.ActivityOverTimeMetric(window=30, surveyYears=1.5),
+                moMetrics.ActivityOverPeriodMetric(window=30, nBins=10)]
+
+    def testMetricBackends(self):
+        slicePoints = self._slicePoints()
+        batch = MoSlicer.__new__(MoSlicer).makeBatch(slicePoints)
+        for metric in self._metrics():
+            results = []
+            for useNumba in (False, True):
+                moKernels.useNumba = useNumba
+                batchValues = metric.runBatch(batch)
+                for i, slicePoint in enumerate(slicePoints):
+                    if len(slicePoint['obs']) == 0:
+                        self.assertTrue(np.all(batchValues[i] == 0))
+                        continue
+                    values = metric.runH(slicePoint['obs'], slicePoint['orbit'], slicePoint['Hvals'])
+                    np.testing.assert_array_equal(batchValues[i], values, err_msg=metric.name)
+                results.append(batchValues)
+            np.testing.assert_array_equal(results[0], results[1], err_msg=metric.name)
+
+    def testCountOccupiedBins(self):
+        for nObj in (1, 5, 50):
+            nObs = self.rng.choice([0, 1, 3, 40], nObj)
+            offsets = np.concatenate([[0], np.cumsum(nObs)])
+            values = self.rng.uniform(-5, 105, offsets[-1])
+            values[::7] = 100.0
+            vis = self.rng.random_sample((offsets[-1], 4)) < 0.6
+            bins = np.arange(0, 101, 10.0)
+            counts = []
+            for useNumba in (False, True):
+                moKernels.useNumba = useNumba
+                counts.append(moKernels.countOccupiedBins(values, offsets, bins, vis))
+            np.testing.assert_array_equal(counts[0], counts[1])
+            for o in range(nObj):
+                for j in range(vis.shape[1]):
+                    objValues = values[offsets[o]:offsets[o+1]][vis[offsets[o]:offsets[o+1], j]]
+                    n, b = np.histogram(objValues, bins=bins)
+                    self.assertEqual(counts[0][o, j], np.sum(n > 0))
+
+    def testDiscoveryChances(self):
+        for nObj in (1, 5, 50):
+            nObs = self.rng.choice([0, 1, 3, 40], nObj)
+            offsets = np.concatenate([[0], np.cumsum(nObs)])
+            nights = self.rng.randint(0, 60, offsets[-1]).astype(float)
+            times = nights + self.rng.choice([0.0, 0.01, 0.03, 0.2], offsets[-1])
+            vis = self.rng.random_sample((offsets[-1], 3)) < 0.7
+            for timeBins in (None, np.array([10., 30., 61.])):
+                counts = []
+                for useNumba in (False, True):
+                    moKernels.useNumba = useNumba
+                    counts.append(moKernels.discoveryChances(nights, times, offsets, vis, 2, 0.05, 2, 10,
+                                                             timeBins=timeBins))
+                np.testing.assert_array_equal(counts[0], counts[1])
+                # The last time bin is after every night, so it counts all of the discovery chances.
+                if timeBins is not None:
+                    moKernels.useNumba = False
+                    np.testing.assert_array_equal(counts[0][:, :, -1],
+                                                  moKernels.discoveryChances(nights, times, offsets, vis,
+                                                                             2, 0.05, 2, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()
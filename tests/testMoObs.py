@@ -0,0 +1,78 @@
+import unittest
+import numpy as np
+from moObs import EphInterpolator, PointingIndex
+
+
+def _angularSeparation(ra1, dec1, ra2, dec2):
+    """Angular separation (radians) between positions in radians."""
+    return 2.0 * np.arcsin(np.sqrt(np.sin((dec2 - dec1) / 2.0)**2 +
+                                   np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2.0)**2))
+
+
+class TestPointingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(42)
+        self.times = np.arange(49353.0, 49383.0 + 0.01, 0.5)
+        self.radius = np.radians(1.75)
+
+    def _ephs(self, ra, dec):
+        ephs = np.zeros((1, len(self.times)), dtype=[('time', float), ('ra', float), ('dec', float)])
+        ephs['time'] = self.times
+        ephs['ra'] = ra
+        ephs['dec'] = dec
+        return ephs
+
+    def _visits(self, interp, nVisits=20000):
+        """Visits scattered around the track of the object (plus some anywhere on the sky)."""
+        expMJD = self.rng.uniform(self.times[0], self.times[-1], nVisits)
+        expMJD[-10:] = self.times[-1]
+        pos = interp.interpolate(expMJD, cols=['ra', 'dec'])
+        offset = self.rng.uniform(0, 3 * self.radius, nVisits)
+        angle = self.rng.uniform(0, 2 * np.pi, nVisits)
+        dec = np.clip(np.radians(pos['dec']) + offset * np.sin(angle), -np.pi/2.0, np.pi/2.0)
+        ra = (np.radians(pos['ra']) + offset * np.cos(angle) / np.maximum(np.cos(dec), 0.01)) % (2 * np.pi)
+        nSky = nVisits // 10
+        ra[:nSky] = self.rng.uniform(0, 2 * np.pi, nSky)
+        dec[:nSky] = np.arcsin(self.rng.uniform(-1, 1, nSky))
+        simdata = np.zeros(nVisits, dtype=[('expMJD', float), ('fieldRA', float), ('fieldDec', float)])
+        simdata['expMJD'] = expMJD
+        simdata['fieldRA'] = ra
+        simdata['fieldDec'] = dec
+        return simdata.view(np.recarray)
+
+    def _checkCandidates(self, ra, dec):
+        """Check that the candidates include every visit found by a brute force search."""
+        interp = EphInterpolator(self._ephs(ra, dec))
+        simdata = self._visits(interp)
+        pos = interp.interpolate(simdata['expMJD'], cols=['ra', 'dec'])
+        sep = _angularSeparation(np.radians(pos['ra']), np.radians(pos['dec']),
+                                 simdata['fieldRA'], simdata['fieldDec'])
+        expected = np.where(sep < self.radius)[0]
+        self.assertTrue(len(expected) > 0)
+        for nside in (1, 2, 4, 8, 16):
+            candidates = PointingIndex(simdata, self.times, nside=nside).candidates(interp, self.radius)
+            self.assertTrue(np.all(np.diff(candidates) > 0))
+            missing = np.setdiff1d(expected, candidates)
+            self.assertEqual(len(missing), 0, 'nside %d: missed visits %s' %(nside, missing))
+
+    def testSlowMover(self):
+        t = self.times - self.times[0]
+        self._checkCandidates(120.0 + 0.2 * t, -20.0 + 0.1 * t)
+
+    def testPole(self):
+        t = self.times - self.times[0]
+        self._checkCandidates((30.0 + 4.0 * t) % 360.0, 88.5 + 0.02 * t)
+        self._checkCandidates((200.0 - 3.0 * t) % 360.0, -89.0 + 0.01 * t)
+
+    def testRaWrap(self):
+        t = self.times - self.times[0]
+        self._checkCandidates((355.0 + 0.4 * t) % 360.0, 5.0 - 0.1 * t)
+
+    def testFastMover(self):
+        t = self.times - self.times[0]
+        self._checkCandidates((10.0 + 6.0 * t) % 360.0, -60.0 + 3.0 * t)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from moObsIO import TextObsWriter
+from moObs import _rowObjIds
+
+
+class TestTextObsWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def _blocks(self):
+        orbits = pd.DataFrame({'objId': [1000, 7], 'q': [1.388894, 0.883445]})
+        blocks = []
+        for objId, nObs in zip(_rowObjIds(orbits), (2, 1)):
+            blocks.append(np.rec.fromarrays([np.repeat(objId, nObs),
+                                             np.array([281.9693437559485, 1e-05, 0.1])[:nObs],
+                                             np.array([69, 140, 1])[:nObs],
+                                             np.array(['u', 'y', 'r'])[:nObs],
+                                             np.array([-0.14920179965410343, 23.0, 1.0/3.0])[:nObs]],
+                                            names=['objId', 'ra', 'night', 'filter', 'dmagDetect']))
+        return blocks
+
+    def testGoldenOutput(self):
+        """Test that the text output is unchanged (as written row by row with '%s ')."""
+        expected = ('objId ra night filter dmagDetect \n'
+                    '1000.0 281.9693437559485 69 u -0.14920179965410343 \n'
+                    '1000.0 1e-05 140 y 23.0 \n'
+                    '7.0 281.9693437559485 69 u -0.14920179965410343 \n')
+        for bufferSize in (1, 8*1024*1024):
+            outfileName = os.path.join(self.outDir, 'obs_%d.txt' %(bufferSize))
+            writer = TextObsWriter(outfileName, bufferSize=bufferSize)
+            for block in self._blocks():
+                writer.write(block)
+            writer.close()
+            with open(outfileName, 'r') as f:
+                self.assertEqual(f.read(), expected)
+
+    def testRowObjIds(self):
+        """Test that the objIds are written as they appear in the rows of the orbits."""
+        for orbits in (pd.DataFrame({'objId': [3, 1000], 'q': [1.0, 2.0]}),
+                       pd.DataFrame({'objId': ['S1', 'S2'], 'q': [1.0, 2.0]})):
+            self.assertEqual(['%s' %(objId) for objId in _rowObjIds(orbits)],
+                             ['%s' %(row['objId']) for i, row in orbits.iterrows()])
+
+
+if __name__ == "__main__":
+    unittest.main()
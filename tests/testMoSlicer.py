@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from moSlicer import MoSlicer
+
+
+class TestMoSlicerStream(unittest.TestCase):
+
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+        self.orbitfile = os.path.join(self.outDir, 'orbits.des')
+        with open(self.orbitfile, 'w') as f:
+            print >>f, '!!ObjID q e i Omega argperi t_p t_0 H'
+            for objId in range(1, 5):
+                print >>f, '%d 1.5 0.1 10.0 20.0 30.0 49100.0 49353.0 %.1f' %(objId, 18 + objId)
+        # Object 2 is split across the first and second chunks (of 4 rows); dmagDetect only has integer values in
+        # the first chunk, and night only has integer values in every chunk (so pandas infers different dtypes).
+        rows = [(1, 49400.1, 1, 0), (1, 49401.1, 2, 0), (2, 49402.1, 3, 0), (2, 49403.1, 4, 0),
+                (2, 49404.1, 5, 0.25), (3, 49405.1, 6, 0.5), (3, 49406.1, 7, 0.75), (4, 49407.1, 8, 1)]
+        self.obsfile = os.path.join(self.outDir, 'obs.txt')
+        with open(self.obsfile, 'w') as f:
+            print >>f, 'objId expMJD night dmagDetect magV dmagColor fiveSigmaDepth filter'
+            for objId, expMJD, night, dmagDetect in rows:
+                print >>f, objId, expMJD, night, dmagDetect, 20.0, 0.1, 24.0, 'r'
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def testSplitObject(self):
+        """Test that streaming in chunks gives the same observations as reading the whole file."""
+        slicer = MoSlicer(self.orbitfile)
+        slicer.readObs(self.obsfile)
+        expected = [slicePoint['obs'] for slicePoint in slicer]
+        for chunkSize in (1, 3, 4, 100):
+            slicer = MoSlicer(self.orbitfile)
+            slicer.readObs(self.obsfile, chunkSize=chunkSize)
+            streamed = [slicePoint['obs'] for slicePoint in slicer]
+            self.assertEqual(len(streamed), len(expected))
+            for obs, expectedObs in zip(streamed, expected):
+                self.assertEqual(len(obs), len(expectedObs))
+                for col in ('objId', 'expMJD', 'night', 'dmagDetect', 'magFilter'):
+                    np.testing.assert_array_equal(obs[col], expectedObs[col])
+                np.testing.assert_array_equal(obs['filter'], expectedObs['filter'])
+
+
+if __name__ == "__main__":
+    unittest.main()